@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of the error page normalizer (request2._clean_page).
+
+Compares the single-pass normalizer with the chain of re.sub calls it
+replaced, on generated ~100 KB HTML pages with times, dates, links and
+paths, and reports how many pages get the same checksum from both.
+
+Run from the root of the repository:
+
+    python3 bench/bench_clean_page.py
+"""
+
+import hashlib
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from classes.request2 import _clean_page
+
+
+def clean_page_chain(page):
+	# the previous implementation of _clean_page. Two of its
+	# replacements were str for bytes patterns, which would raise a
+	# TypeError on a match. They never matched, as the first pass
+	# removes all runs of two or more digits, so b'' is the same
+	page = re.sub(rb'(\d?\d:?){2,3}', b'', page)
+	page = re.sub(rb'AM', b'', page, flags=re.IGNORECASE)
+	page = re.sub(rb'PM', b'', page, flags=re.IGNORECASE)
+	page = re.sub(rb'(\d){13}', b'', page)
+	page = re.sub(rb'(\d){8}', b'', page)
+	page = re.sub(rb'\d{4}-\d{2}-\d{2}', b'', page)
+	page = re.sub(rb'\d{4}/\d{2}/\d{2}', b'', page)
+	page = re.sub(rb'\d{2}-\d{2}-\d{4}', b'', page)
+	page = re.sub(rb'\d{2}/\d{2}/\d{4}', b'', page)
+	page = re.sub(rb'(\d){6}', b'', page)
+	page = re.sub(rb'\d{2}-\d{2}-\d{2}', b'', page)
+	page = re.sub(rb'\d{2}/\d{2}/\d{2}', b'', page)
+	page = re.sub(rb'/[^ ]+', b'', page)
+	page = re.sub(b'[a-zA-Z]:\\[^ ]+', b'', page)
+	return hashlib.md5(page).hexdigest().lower()
+
+
+def generate_page(rnd, size=100 * 1024):
+	words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'error', 'page', 'not', 'found', 'server']
+	parts = ['<!DOCTYPE html>\n<html><head><title>Page</title>']
+	length = len(parts[0])
+
+	while length < size:
+		choice = rnd.randint(0, 6)
+		if choice == 0:
+			part = '<p>Generated %02d:%02d:%02d %s</p>\n' % (rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59), rnd.choice(['AM', 'PM']))
+		elif choice == 1:
+			part = '<span>%04d-%02d-%02d</span> <span>%02d/%02d/%04d</span>\n' % (rnd.randint(1990, 2030), rnd.randint(1, 12), rnd.randint(1, 28), rnd.randint(1, 28), rnd.randint(1, 12), rnd.randint(1990, 2030))
+		elif choice == 2:
+			part = '<a href="/%s/%s.html?id=%d">link</a>\n' % (rnd.choice(words), rnd.choice(words), rnd.randint(0, 10**6))
+		elif choice == 3:
+			part = '<script src="/js/%s.js?v=%d"></script>\n' % (rnd.choice(words), rnd.randint(10**12, 10**13))
+		elif choice == 4:
+			part = '<pre>C:\\inetpub\\wwwroot\\%s.aspx line %d</pre>\n' % (rnd.choice(words), rnd.randint(1, 999))
+		else:
+			part = '<p>%s</p>\n' % (' '.join(rnd.choice(words) for _ in range(rnd.randint(5, 40))), )
+
+		parts.append(part)
+		length += len(part)
+
+	parts.append('</html>')
+	return ''.join(parts).encode('utf-8')
+
+
+def bench(function, pages, rounds):
+	best = None
+	for _ in range(rounds):
+		start = time.perf_counter()
+		for page in pages:
+			function(page)
+		duration = time.perf_counter() - start
+		best = duration if best is None else min(best, duration)
+
+	return best
+
+
+def main():
+	rnd = random.Random(1)
+	pages = [generate_page(rnd) for _ in range(20)]
+	size = sum(len(page) for page in pages)
+
+	print('%s pages, %.1f KB on average' % (len(pages), size / len(pages) / 1024))
+	for name, function in [('re.sub chain', clean_page_chain), ('single pass', _clean_page)]:
+		duration = bench(function, pages, 5)
+		print('%-14s %7.2f ms/page  %7.1f MB/s' % (name, duration / len(pages) * 1000, size / duration / 1024 / 1024))
+
+	# the pages without windows paths should get the same checksum
+	rnd = random.Random(2)
+	same = 0
+	for _ in range(20):
+		page = generate_page(rnd).replace(b'C:\\', b'')
+		same += clean_page_chain(page) == _clean_page(page)
+	print('same checksum as the chain: %s/20 pages without windows paths' % (same, ))
+
+
+if __name__ == '__main__':
+	main()
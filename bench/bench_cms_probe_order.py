@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the order in which DiscoverCMS requests the CMS urls.
+
+Simulates a site for every version of every CMS in the fingerprints,
+and counts the requests DiscoverCMS makes before the first response
+that identifies the CMS, for the previous order (the reverse of the
+order the fingerprints are loaded in) and for the order of
+fingerprints.get_probe_order.
+
+A site is identified by a url if the url has a md5 fingerprint for
+its version, or any other fingerprint for its CMS (see
+fingerprints.get_identified). The medians are reported over all the
+sites, and with every CMS weighted the same, as the CMSs with many
+versions would otherwise decide the result.
+
+Many sites do not show their CMS in the pages the string and regex
+fingerprints are for (e.g. a generator tag on the front page), so the
+same is also done with only the md5 fingerprints identifying a site.
+
+Run from the root of the repository:
+
+    python3 bench/bench_cms_probe_order.py
+"""
+
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from classes.fingerprints import Fingerprints
+from classes.fingerprints import get_identified
+from classes.fingerprints import get_probe_order
+
+
+def count_requests(order, identified):
+	# site -> the number of requests before it is identified
+	requests = {}
+	for number, url in enumerate(order, 1):
+		for pair in identified[url]:
+			requests.setdefault(pair, number)
+
+	return requests
+
+
+def weighted_median(requests, weights):
+	total = 0
+	for count, pair in sorted((count, pair) for pair, count in requests.items()):
+		total += weights[pair]
+		if total >= 0.5:
+			return count
+
+
+def report(title, order_list, identified, weights):
+	names = set(name for name, version in weights)
+	print('%s: %s CMSs, %s sites (CMS versions)' % (title, len(names), len(weights)))
+	print('%-14s %16s %16s %10s' % ('order', 'median (sites)', 'median (CMSs)', 'mean'))
+
+	for name, order in order_list:
+		requests = count_requests(order, identified)
+		print('%-14s %16s %16s %10.1f' % (
+			name,
+			statistics.median(requests.values()),
+			weighted_median(requests, weights),
+			statistics.mean(requests.values())))
+	print()
+
+
+def main():
+	fps = Fingerprints(compiled_file=None)
+	url_index = fps.get_url_index('cms')
+
+	start = time.perf_counter()
+	probe_order = get_probe_order(url_index)
+	duration = time.perf_counter() - start
+
+	print('%s urls, probe order computed in %.1f ms' % (len(url_index), duration * 1000))
+	print()
+
+	orders = [
+		('before', list(reversed(list(url_index)))),
+		('probe order', probe_order),
+	]
+
+	identified, weights = get_identified(url_index)
+	report('all fingerprints', orders, identified, weights)
+
+	md5_index = {url: [fp for fp in fps if fp.get('type') == 'md5'] for url, fps in url_index.items()}
+	identified, weights = get_identified(md5_index)
+	report('md5 fingerprints only', orders, identified, weights)
+
+
+if __name__ == '__main__':
+	main()
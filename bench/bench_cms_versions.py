@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the requests DiscoverCMS makes to find the version of a
+CMS.
+
+Simulates a site for every version of every CMS in the md5
+fingerprints, and counts the requests made once the CMS has been
+detected, when all the urls of the CMS are requested
+(--exhaustive_versions) and when only the urls chosen by
+VersionResolver are. A site responds at a url with the md5 its
+version has there, or with a page no fingerprint matches.
+
+The versions are scored as Results does for md5 fingerprints, and the
+number of sites for which the two give different versions is
+reported. This is done for three kinds of sites:
+- the files of a single version, which should give 0 differences
+- with 2% of the files missing, at least one, which should also
+  give 0
+- with 2% of the files from other versions, at least one, as after a partial
+  upgrade. The resolver does not give the same versions for all of
+  these sites, as it stops once the responses agree on the versions
+
+Run from the root of the repository:
+
+	python3 bench/bench_cms_versions.py
+"""
+
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from classes.discovery import VersionResolver
+from classes.fingerprints import Fingerprints
+
+
+# the share of the files of a site that are missing, or from other versions
+SHARE = 0.02
+
+
+def sample(rng, urls, share):
+	# the share of the urls, at least one if the share is not 0
+	count = max(1, round(len(urls) * share)) if share > 0 else 0
+	return rng.sample(urls, min(count, len(urls)))
+
+
+def get_site(md5s, version, rng, missing=0, changed=0):
+	# url -> the md5 of the response of a site with the version
+	site = {url: by_version[version] for url, by_version in md5s.items() if version in by_version}
+	urls = sorted(site)
+
+	for url in sample(rng, urls, missing):
+		del site[url]
+		urls.remove(url)
+
+	for url in sample(rng, urls, changed):
+		others = sorted(set(md5s[url].values()) - {site[url]})
+		if len(others) > 0:
+			site[url] = rng.choice(others)
+
+	return site
+
+
+def get_matches(fps, md5):
+	# the fingerprints that match a response with the md5
+	return [fp for fp in fps if fp.get('type') == 'md5' and fp['match'] == md5]
+
+
+def get_versions(matches_by_url):
+	# the versions with the top score, as in Results
+	scores = Counter()
+	for matches in matches_by_url.values():
+		versions = Counter(fp['output'] for fp in matches)
+		for version in versions:
+			scores[version] += 1 / sum(versions.values())
+
+	top = max(scores.values(), default=0)
+	return set(version for version, score in scores.items() if score == top)
+
+
+def scan(fps_by_url, site):
+	# url -> matches, for the urls requested by VersionResolver
+	resolver = VersionResolver(fps_by_url)
+	matches_by_url = {}
+	rounds = 0
+
+	queue = resolver.get_queue()
+	while len(queue) > 0:
+		rounds += 1
+		for fps in queue:
+			url = fps[0]['url']
+			matches_by_url[url] = get_matches(fps, site.get(url))
+			resolver.add_result(url, matches_by_url[url])
+		queue = resolver.get_queue()
+
+	return matches_by_url, rounds
+
+
+def run(cms_index, title, **kwargs):
+	rng = random.Random(0)
+	exhaustive, resolved, rounds, differences, affected = [], [], [], 0, 0
+	start = time.perf_counter()
+
+	for name, fps_by_url in sorted(cms_index.items()):
+		md5s = VersionResolver(fps_by_url).md5s
+		versions = set(version for by_version in md5s.values() for version in by_version)
+
+		for version in sorted(versions):
+			site = get_site(md5s, version, rng, **kwargs)
+			if site != get_site(md5s, version, rng):
+				affected += 1
+			matches_by_url = {url: get_matches(fps_by_url[url], site.get(url)) for url in fps_by_url}
+			found, scan_rounds = scan(fps_by_url, site)
+
+			exhaustive.append(len(matches_by_url))
+			resolved.append(len(found))
+			rounds.append(scan_rounds)
+			if get_versions(matches_by_url) != get_versions(found):
+				differences += 1
+
+	duration = time.perf_counter() - start
+
+	print('%s: %s sites (CMS versions), simulated in %.1f s' % (title, len(exhaustive), duration))
+	print('%-12s %10s %10s %10s' % ('requests', 'median', 'mean', 'total'))
+	for name, counts in [('exhaustive', exhaustive), ('resolver', resolved)]:
+		print('%-12s %10s %10.1f %10s' % (name, statistics.median(counts), statistics.mean(counts), sum(counts)))
+	print('rounds of the resolver: median %s, max %s' % (statistics.median(rounds), max(rounds)))
+	print('sites with missing or changed files: %s' % (affected, ))
+	print('sites with different versions: %s' % (differences, ))
+	print()
+
+
+def main():
+	fps = Fingerprints(compiled_file=None)
+	cms_index = fps.get_name_index('cms')
+
+	run(cms_index, 'single version')
+	run(cms_index, '%d%% of the files missing' % (SHARE * 100, ), missing=SHARE)
+	run(cms_index, '%d%% of the files from other versions' % (SHARE * 100, ), changed=SHARE)
+
+
+if __name__ == '__main__':
+	main()
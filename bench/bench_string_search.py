@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of the search for the patterns of the string
+fingerprints in a response body (see matcher.FingerprintIndex).
+
+Compares searching for each unique pattern with 'in' with two single
+scans of the body:
+- a combined regex: an alternation of the escaped patterns in a
+  lookahead, longest first, which finds the longest pattern at each
+  position, and with it the patterns that are its prefixes
+- an Aho-Corasick automaton in Python, with one transition per
+  character of the body
+
+The bodies are generated HTML pages of different sizes, with some of
+the patterns in them. The patterns found by all three are checked to
+be the same.
+
+Run from the root of the repository:
+
+	python3 bench/bench_string_search.py
+"""
+
+import os
+import random
+import re
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from classes.fingerprints import Fingerprints
+
+
+def get_patterns(fps, category):
+	patterns = set()
+	for fp_type in fps.data[category]:
+		for fp in fps.data[category][fp_type]['fps']:
+			if fp.get('type') == 'string' and 'header' not in fp:
+				patterns.add(fp['match'])
+
+	return sorted(patterns, key=len, reverse=True)
+
+
+def search_in(patterns, body):
+	return set(pattern for pattern in patterns if pattern in body)
+
+
+def get_combined_search(patterns):
+	regex = re.compile('(?=(%s))' % ('|'.join(re.escape(pattern) for pattern in patterns), ))
+	prefixes = {pattern: [other for other in patterns if pattern.startswith(other)] for pattern in patterns}
+
+	def search(body):
+		found = set()
+		for match in regex.finditer(body):
+			found.update(prefixes[match.group(1)])
+		return found
+
+	return search
+
+
+def get_automaton_search(patterns):
+	# the goto function, as a dict of the transitions of each state, the
+	# failure links, and the patterns that end at each state
+	goto = [{}]
+	output = [set()]
+	for pattern in patterns:
+		state = 0
+		for char in pattern:
+			if char not in goto[state]:
+				goto.append({})
+				output.append(set())
+				goto[state][char] = len(goto) - 1
+			state = goto[state][char]
+		output[state].add(pattern)
+
+	fail = [0] * len(goto)
+	queue = deque(goto[0].values())
+	while queue:
+		state = queue.popleft()
+		for char, next_state in goto[state].items():
+			queue.append(next_state)
+			link = fail[state]
+			while link and char not in goto[link]:
+				link = fail[link]
+			fail[next_state] = goto[link].get(char, 0)
+			output[next_state] |= output[fail[next_state]]
+
+	def search(body):
+		found = set()
+		state = 0
+		for char in body:
+			while state and char not in goto[state]:
+				state = fail[state]
+			state = goto[state].get(char, 0)
+			if output[state]:
+				found |= output[state]
+		return found
+
+	return search
+
+
+def get_body(size, patterns):
+	parts = ['<div class="content">', '<a href="/page/1">', '</a>', '</div>', 'lorem ipsum dolor sit amet ',
+		'<script src="/js/main.js"></script>', '<p>', '</p>', '12:30 PM ']
+	parts.extend(random.sample(patterns, min(3, len(patterns))))
+
+	body = []
+	length = 0
+	while length < size:
+		part = random.choice(parts)
+		body.append(part)
+		length += len(part)
+
+	return ''.join(body)
+
+
+def timed(function, body, repeat):
+	start = time.perf_counter()
+	for _ in range(repeat):
+		result = function(body)
+
+	return result, (time.perf_counter() - start) / repeat
+
+
+def main():
+	random.seed(0)
+	fps = Fingerprints(compiled_file=None)
+
+	for category in ['cms', 'platform']:
+		patterns = get_patterns(fps, category)
+		combined = get_combined_search(patterns)
+		automaton = get_automaton_search(patterns)
+
+		print('%s: %s unique patterns' % (category, len(patterns)))
+		print('%10s %12s %12s %12s %8s' % ('body', "'in'", 'combined', 'automaton', 'same'))
+		for size in [2 * 1024, 50 * 1024, 500 * 1024]:
+			body = get_body(size, patterns)
+			repeat = max(1, 2 * 1024 * 1024 // size)
+
+			found_in, duration_in = timed(lambda body: search_in(patterns, body), body, repeat)
+			found_combined, duration_combined = timed(combined, body, repeat)
+			found_automaton, duration_automaton = timed(automaton, body, repeat)
+
+			same = found_in == found_combined == found_automaton
+			print('%8s KB %9.0f us %9.0f us %9.0f us %8s' % (size // 1024, duration_in * 1e6, duration_combined * 1e6, duration_automaton * 1e6, same))
+		print()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,371 @@
+import asyncio
+import email.parser
+import http.client
+import queue
+import ssl
+import threading
+import time
+import urllib.parse
+from collections import defaultdict
+
+from classes.request2 import ACCEPT_ENCODING
+from classes.request2 import Requester
+from classes.request2 import OutOfScopeException
+from classes.request2 import ResponseBody
+from classes.request2 import _build_response
+
+
+class AsyncConnectionPool(object):
+	"""
+	Keep-alive connections for the AsyncRequester.
+
+	This is the asyncio counterpart of request2.ConnectionPool. It
+	is only used from the event loop, so it does not need a lock.
+	"""
+
+	def __init__(self, max_size=100, idle_timeout=15):
+		self.max_size = max_size
+		self.idle_timeout = idle_timeout
+
+		# key -> [(reader, writer, time of last use)]
+		self.idle = defaultdict(list)
+
+	def get(self, key):
+		now = time.time()
+		connections = self.idle[key]
+		while connections:
+			reader, writer, last_used = connections.pop()
+			if now - last_used < self.idle_timeout and not reader.at_eof():
+				return reader, writer
+			writer.close()
+
+		return None
+
+	def put(self, key, reader, writer):
+		connections = self.idle[key]
+		if len(connections) < self.max_size and not reader.at_eof():
+			connections.append((reader, writer, time.time()))
+		else:
+			writer.close()
+
+	def close(self):
+		for key in self.idle:
+			for reader, writer, last_used in self.idle[key]:
+				writer.close()
+		self.idle.clear()
+
+
+class AsyncRequester(Requester):
+	"""
+	A Requester that drives all the requests of a batch on a single
+	asyncio event loop, instead of a thread per request.
+
+	The HTTP/1.1 client is implemented on top of asyncio streams. It
+	follows redirections within the scope of the host in the same way
+	as request2.RedirectHandler. The event loop runs in a background
+	thread, so 'run' returns the same queue of (fp_list, Response)
+	tuples as the Requester.
+
+	The cache can read from the database, so it is used from the
+	threads of the Requester (see _in_thread), and the event loop keeps
+	running the other requests in the meantime. Its writes to the
+	database are done by its own writer thread.
+	"""
+
+	max_redirections = 10
+
+	def __init__(self, options, data):
+		super().__init__(options, data)
+		self.concurrency = options['concurrency']
+		self.timeout = 30
+		self.window = self.concurrency
+
+		self.loop = None
+		self.loop_thread = None
+		self.loop_lock = threading.Lock()
+		self.async_pool = AsyncConnectionPool(max_size=self.concurrency)
+
+		# limits the requests of all the runs. It is created on the
+		# event loop, when it is first needed
+		self.semaphore = None
+
+		self.ssl_context = ssl.create_default_context()
+
+		# the proxy is given as 'host:port'
+		self.proxy_data = None
+		if self.proxy:
+			proxy = self.proxy if '://' in self.proxy else 'http://' + self.proxy
+			self.proxy_data = urllib.parse.urlparse(proxy)
+
+	def _get_loop(self):
+		with self.loop_lock:
+			if self.loop is None:
+				self.loop = asyncio.new_event_loop()
+				self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+				self.loop_thread.start()
+
+		return self.loop
+
+	def _run_coroutine(self, coroutine):
+		return asyncio.run_coroutine_threadsafe(coroutine, self._get_loop()).result()
+
+	def close(self):
+		super().close()
+
+		if self.loop is not None:
+			async def close_pool():
+				self.async_pool.close()
+
+			self._run_coroutine(close_pool())
+			self.loop.call_soon_threadsafe(self.loop.stop)
+			self.loop_thread.join()
+			self.loop.close()
+			self.loop = None
+			self.semaphore = None
+
+	async def _in_thread(self, function, *args):
+		return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+	def _look_up(self, complete_url, can_use_head):
+		# see request_async. Returns the cached response, if the path is
+		# known to be missing, and the stale response to revalidate
+		if complete_url in self.cache:
+			return self.cache[complete_url], False, None
+
+		if self._is_known_missing(complete_url, can_use_head):
+			return None, True, None
+
+		return None, False, self._get_stale(complete_url)
+
+	async def _open_connection(self, url_data):
+		host = url_data.hostname
+		port = url_data.port or (443 if url_data.scheme == 'https' else 80)
+		context = self.ssl_context if url_data.scheme == 'https' else None
+
+		if self.proxy_data is None:
+			return await asyncio.open_connection(host, port, ssl=context)
+
+		reader, writer = await asyncio.open_connection(self.proxy_data.hostname, self.proxy_data.port or 8080)
+
+		# tunnel https through the proxy
+		if context is not None:
+			target = '%s:%s' % (host, port)
+			writer.write(('CONNECT %s HTTP/1.1\r\nHost: %s\r\n\r\n' % (target, target)).encode('ascii'))
+			await writer.drain()
+
+			code, reason, headers = await self._read_head(reader)
+			if not code == 200:
+				writer.close()
+				raise OSError('Tunnel connection failed: %s %s' % (code, reason))
+
+			await writer.start_tls(context, server_hostname=host)
+
+		return reader, writer
+
+	async def _read_head(self, reader):
+		status_line = await reader.readline()
+		if not status_line:
+			raise http.client.RemoteDisconnected('Remote end closed connection without response')
+
+		version, code, reason = (status_line.decode('iso-8859-1').rstrip('\r\n').split(None, 2) + [''])[:3]
+		if not version.startswith('HTTP/'):
+			raise http.client.BadStatusLine(status_line)
+
+		lines = []
+		while True:
+			line = await reader.readline()
+			if line in (b'\r\n', b'\n', b''):
+				break
+			lines.append(line.decode('iso-8859-1'))
+
+		headers = email.parser.Parser(_class=http.client.HTTPMessage).parsestr(''.join(lines))
+		return int(code), reason, headers
+
+	async def _read_body(self, reader, method, code, headers, body):
+		# reads the body into 'body' (a ResponseBody) and returns if
+		# the connection can be reused
+		if method == 'HEAD' or code in (204, 304) or 100 <= code < 200:
+			return True
+
+		if 'chunked' in headers.get('transfer-encoding', '').lower():
+			while True:
+				size = int((await reader.readline()).split(b';')[0].strip(), 16)
+				if size == 0:
+					# skip the trailer
+					while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+						pass
+					return True
+
+				while size > 0:
+					chunk = await reader.readexactly(min(size, ResponseBody.chunk_size))
+					body.add(chunk)
+					size -= len(chunk)
+				await reader.readline()
+
+		if headers.get('content-length') is not None:
+			size = int(headers['content-length'])
+			while size > 0:
+				chunk = await reader.readexactly(min(size, ResponseBody.chunk_size))
+				body.add(chunk)
+				size -= len(chunk)
+			return True
+
+		# the body ends when the connection is closed
+		while True:
+			chunk = await reader.read(ResponseBody.chunk_size)
+			if not chunk:
+				return False
+			body.add(chunk)
+
+	async def _send(self, url, method, request_headers):
+		url_data = urllib.parse.urlparse(url)
+		key = (url_data.scheme, url_data.netloc)
+
+		# the request target is the full url when using a plain http proxy
+		target = url_data.path or '/'
+		if url_data.query:
+			target += '?' + url_data.query
+		if self.proxy_data is not None and url_data.scheme == 'http':
+			target = url
+
+		request = '%s %s HTTP/1.1\r\n' % (method, target)
+		request += 'Host: %s\r\n' % (url_data.netloc, )
+		request += 'User-Agent: %s\r\n' % (self.user_agent, )
+		for name, value in request_headers.items():
+			request += '%s: %s\r\n' % (name, value)
+		request += 'Accept-Encoding: %s\r\n' % (ACCEPT_ENCODING, )
+		request += 'Connection: keep-alive\r\n\r\n'
+
+		# a pooled connection might have been closed by the server
+		# in the meantime. If so, retry once with a new connection
+		connection = self.async_pool.get(key)
+		while True:
+			is_reused = connection is not None
+			reader, writer = connection if is_reused else await self._open_connection(url_data)
+
+			try:
+				writer.write(request.encode('iso-8859-1'))
+				await writer.drain()
+				code, reason, headers = await self._read_head(reader)
+				body = ResponseBody(headers.get('content-type'), self.max_body_size, headers.get('content-encoding'))
+				reusable = await self._read_body(reader, method, code, headers, body)
+			except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+				writer.close()
+				if not is_reused:
+					raise
+				connection = None
+				continue
+			except BaseException:
+				# this includes the cancellation by a timeout
+				writer.close()
+				raise
+
+			break
+
+		if reusable and not headers.get('connection', '').lower() == 'close':
+			self.async_pool.put(key, reader, writer)
+		else:
+			writer.close()
+
+		return code, reason, headers, body
+
+	async def _fetch(self, url, method, request_headers):
+		# send the request and follow the redirections
+		org_url = urllib.parse.urlparse(url)
+		visited = set()
+
+		for _ in range(self.max_redirections + 1):
+			code, reason, headers, body = await asyncio.wait_for(self._send(url, method, request_headers), self.timeout)
+
+			if code not in (301, 302, 303, 307, 308) or 'location' not in headers:
+				return url, code, reason, headers.items(), body
+
+			# see request2.RedirectHandler
+			new_url = urllib.parse.urlparse(headers['location'])
+			if headers['location'].startswith('/'):
+				new_url = new_url._replace(scheme=org_url.scheme, netloc=org_url.netloc)
+
+			if not new_url.netloc == org_url.netloc:
+				raise OutOfScopeException(org_url, new_url)
+
+			url = urllib.parse.urljoin(url, headers['location'])
+			if url in visited:
+				break
+			visited.add(url)
+
+		raise http.client.HTTPException('Too many redirections: %s' % (url, ))
+
+	async def do_request_async(self, url, run_type=None, method='GET', stale=None):
+		final_url, code, reason, headers, body = await self._fetch(url, method, self._get_validators(stale))
+
+		# the stale response is still valid
+		if stale is not None and code == 304:
+			R = stale
+		else:
+			R = _build_response(final_url, code, reason, headers, body)
+			R.method = method
+
+		await self._in_thread(self._store_response, R, url, final_url, run_type)
+
+		return R
+
+	async def request_async(self, fp_list, run_type):
+		# see Requester.request
+		url = fp_list[0]['url']
+		complete_url = urllib.parse.urljoin(self.url, url)
+
+		R = None
+
+		can_use_head = self._can_use_head(fp_list)
+
+		# check if the url is out of scope
+		if not self._is_in_scope(complete_url):
+			return (fp_list, R)
+
+		R, is_missing, stale = await self._in_thread(self._look_up, complete_url, can_use_head)
+		if R is None and not is_missing:
+			try:
+				# if it is possible to use 'HEAD', use it. If the result is
+				# a '200', request the resource with a 'GET'
+				get_resource = True
+				if can_use_head and stale is None:
+					response = await self.do_request_async(complete_url, run_type, method='HEAD')
+					if not response.status['code'] == 200:
+						get_resource = False
+						await self._in_thread(self.cache.add_missing, complete_url, response.status['code'])
+
+				# Fetch the ressource if the resource exists or
+				# if the fingerprint requires any response
+				if get_resource:
+					await self.do_request_async(complete_url, run_type, method='GET', stale=stale)
+					R = await self._in_thread(self.cache.__getitem__, complete_url)
+
+			except Exception as e:
+				await self._in_thread(self.cache.add_missing, complete_url, 0)
+
+		return (fp_list, R)
+
+	def request(self, fp_list, run_type):
+		return self._run_coroutine(self.request_async(fp_list, run_type))
+
+	async def _limited_request(self, fp_list, run_type):
+		if self.semaphore is None:
+			self.semaphore = asyncio.Semaphore(self.concurrency)
+
+		async with self.semaphore:
+			return await self.request_async(fp_list, run_type)
+
+	async def _run(self, run_type, fp_lists, requested):
+		for future in asyncio.as_completed([self._limited_request(fp_list, run_type) for fp_list in fp_lists]):
+			requested.put(await future)
+
+	def run(self, run_type=None, fp_lists=[]):
+		# see Requester.run
+		requested = queue.Queue()
+		self._run_coroutine(self._run(run_type, fp_lists, requested))
+
+		return requested
+
+	def _submit(self, fp_list, run_type):
+		# see Requester.stream. Cancelling the future cancels the request
+		return asyncio.run_coroutine_threadsafe(self._limited_request(fp_list, run_type), self._get_loop())
@@ -2,12 +2,461 @@ import sys
 
 if sys.version_info.major == 3:
     import queue
+    import urllib.parse as urlparse
 elif sys.version_info.major == 2:
     import Queue as queue
+    import urlparse
 
+import contextlib
+import copy
+import itertools
+import operator
 import pickle
 import os
+import re
+import sqlite3
+import threading
 import time
+import zlib
+from collections import defaultdict
+from collections import Counter
+from collections import OrderedDict
+
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+_UNRESERVED = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+_PERCENT_ESCAPE = re.compile('%([0-9A-Fa-f]{2})')
+
+
+def _normalize_escapes(part):
+	# decode the escaped unreserved characters, and use upper case
+	# for the other escapes (RFC 3986, section 6.2.2)
+	def normalize(match):
+		char = chr(int(match.group(1), 16))
+		return char if char in _UNRESERVED else '%' + match.group(1).upper()
+
+	return _PERCENT_ESCAPE.sub(normalize, part)
+
+
+def _remove_dot_segments(path):
+	# see RFC 3986, section 5.2.4
+	segments = path.split('/')
+	output = []
+	for segment in segments:
+		if segment == '.':
+			continue
+		elif segment == '..':
+			if len(output) > 1:
+				output.pop()
+		else:
+			output.append(segment)
+
+	# '/a/..' is '/', not ''
+	if segments[-1] in ('.', '..'):
+		output.append('')
+
+	return '/'.join(output)
+
+
+def canonical_url(url):
+	"""
+	Returns the canonical form of a url, which is used as the key of
+	the cache, so urls that only differ in their spelling share the
+	same response:
+
+	- the scheme and the host are lower case, and the default port
+	  of the scheme is removed
+	- the fragment is removed, as it is not sent to the server
+	- the dot segments are removed from the path, and an empty path
+	  is '/'
+	- percent-escapes are upper case, and escaped unreserved
+	  characters are decoded
+	- the parameters of the query are sorted
+
+	Urls that cannot be parsed are returned as they are.
+	"""
+	try:
+		parts = urlparse.urlsplit(url)
+		port = parts.port
+	except ValueError:
+		return url
+
+	scheme = parts.scheme.lower()
+	userinfo, _, host = parts.netloc.rpartition('@')
+	host = host.lower()
+	if port is not None and port == _DEFAULT_PORTS.get(scheme):
+		host = host.rpartition(':')[0]
+	netloc = userinfo + '@' + host if userinfo else host
+
+	path = _remove_dot_segments(_normalize_escapes(parts.path))
+	if not path and netloc:
+		path = '/'
+
+	query = ''
+	if parts.query:
+		query = '&'.join(sorted(_normalize_escapes(param) for param in parts.query.split('&')))
+
+	return urlparse.urlunsplit((scheme, netloc, path, query, ''))
+
+
+class CacheDatabase(object):
+	"""
+	The SQLite database in which the cache saves the responses.
+
+	The hosts table is the index of the database: it holds the time
+	each host was saved and when its responses expire, so finding the
+	saved responses of a host does not depend on the number of hosts.
+
+	Responses are kept for 'max_age' seconds, so they can be revalidated
+	after they are no longer fresh (see Cache.get_stale).
+
+	The expired responses are removed in batches, at most once every
+	'gc_interval' seconds. The time of the last removal is kept in the
+	meta table, so it is shared by all the scans using the database.
+
+	The database can be used by several Caches, one after another, e.g.
+	when scanning a list of urls. It can also be shared by several wig
+	processes: it is in WAL mode, so readers do not block the writer,
+	and every write is a short 'BEGIN IMMEDIATE' transaction, which is
+	retried while another process holds the write lock. A process sees
+	the responses saved by the others as soon as they are committed.
+
+	The missing table holds the paths of a host that were found missing,
+	with the status of the response, so they are not probed again by the
+	next scans (see Cache.get_missing).
+
+	The bodies are compressed with zlib at 'compression_level', where 0
+	stores them uncompressed. The responses, with their headers and
+	checksums, are stored apart from the bodies, so they can be loaded
+	without decompressing the bodies.
+
+	The threads of a process share the connection, so it is only used
+	while holding 'lock'. The reads use a second connection, under
+	'read_lock', so they do not wait for a write that is waiting for
+	another process. The bodies are compressed and decompressed
+	without holding either lock.
+	"""
+
+	# the version of the database schema. The database is recreated if
+	# it was created for another version
+	schema_version = 5
+
+	def __init__(self, file_name, max_age):
+		self.file_name = file_name
+		self.max_age = max_age
+		self.db = None
+		self.lock = threading.RLock()
+		self.reader = None
+		self.read_lock = threading.Lock()
+		self.compression_level = 6
+
+		# seconds to wait for the write lock of another process, and the
+		# number of times to try to get it
+		self.busy_timeout = 10
+		self.lock_retries = 5
+
+		self.gc_interval = 60*60
+		self.gc_batch_size = 1000
+
+
+	def _connect(self):
+		cache_dir = os.path.dirname(self.file_name)
+		if cache_dir and not os.path.exists(cache_dir):
+			os.makedirs(cache_dir)
+
+		# the responses are written by the worker threads of the requester.
+		# The transactions are started explicitly (see _transaction)
+		db = sqlite3.connect(self.file_name, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+		db.execute('PRAGMA journal_mode = WAL')
+		db.execute('PRAGMA synchronous = NORMAL')
+
+		self.db = db
+		try:
+			with self._transaction() as db:
+				self._create_tables(db)
+		except Exception:
+			self.db = None
+			db.close()
+			raise
+
+
+	def _create_tables(self, db):
+		if not db.execute('PRAGMA user_version').fetchone()[0] == self.schema_version:
+			for table in ['meta', 'hosts', 'responses', 'bodies', 'missing']:
+				db.execute('DROP TABLE IF EXISTS %s' % (table, ))
+			db.execute('PRAGMA user_version = %d' % (self.schema_version, ))
+
+		db.execute('''
+			CREATE TABLE IF NOT EXISTS meta (
+				key TEXT PRIMARY KEY,
+				value INTEGER NOT NULL
+			)''')
+		db.execute('''
+			CREATE TABLE IF NOT EXISTS hosts (
+				host TEXT PRIMARY KEY,
+				saved INTEGER NOT NULL,
+				expires INTEGER NOT NULL
+			)''')
+		db.execute('CREATE INDEX IF NOT EXISTS hosts_expires ON hosts (expires)')
+
+		# the responses are stored without their bodies
+		db.execute('''
+			CREATE TABLE IF NOT EXISTS responses (
+				host TEXT NOT NULL,
+				url TEXT NOT NULL,
+				saved INTEGER NOT NULL,
+				id TEXT NOT NULL,
+				body_md5 TEXT,
+				response BLOB NOT NULL,
+				PRIMARY KEY (host, url)
+			)''')
+		db.execute('CREATE INDEX IF NOT EXISTS responses_saved ON responses (saved)')
+		db.execute('CREATE INDEX IF NOT EXISTS responses_body_md5 ON responses (body_md5)')
+		db.execute('''
+			CREATE TABLE IF NOT EXISTS bodies (
+				md5 TEXT PRIMARY KEY,
+				compressed INTEGER NOT NULL,
+				body BLOB NOT NULL
+			)''')
+		db.execute('''
+			CREATE TABLE IF NOT EXISTS missing (
+				host TEXT NOT NULL,
+				url TEXT NOT NULL,
+				status INTEGER NOT NULL,
+				saved INTEGER NOT NULL,
+				PRIMARY KEY (host, url)
+			)''')
+		db.execute('CREATE INDEX IF NOT EXISTS missing_saved ON missing (saved)')
+
+
+	@contextlib.contextmanager
+	def _transaction(self):
+		with self.lock:
+			db = self.get()
+
+			# get the write lock when the transaction starts, instead of when
+			# it first writes, as another process might have written in between
+			for attempt in range(self.lock_retries):
+				try:
+					db.execute('BEGIN IMMEDIATE')
+					break
+				except sqlite3.OperationalError as err:
+					if attempt == self.lock_retries - 1 or 'locked' not in str(err):
+						raise
+					time.sleep(0.1 * (attempt + 1))
+
+			try:
+				yield db
+			except BaseException:
+				db.execute('ROLLBACK')
+				raise
+			else:
+				db.execute('COMMIT')
+
+
+	def get(self):
+		with self.lock:
+			if self.db is None:
+				self._connect()
+				self._collect_garbage()
+
+			return self.db
+
+
+	def _read(self, query, args):
+		# the tables are created by the first use of the database
+		if self.db is None:
+			self.get()
+
+		with self.read_lock:
+			if self.reader is None:
+				self.reader = sqlite3.connect(self.file_name, timeout=self.busy_timeout, isolation_level=None, check_same_thread=False)
+
+			return self.reader.execute(query, args).fetchone()
+
+
+	def _collect_garbage(self):
+		now = int(time.time())
+		row = self.db.execute('SELECT value FROM meta WHERE key = ?', ('last_gc', )).fetchone()
+		if row is not None and now - row[0] < self.gc_interval:
+			return
+
+		with self._transaction() as db:
+			# another process might just have done it
+			row = db.execute('SELECT value FROM meta WHERE key = ?', ('last_gc', )).fetchone()
+			if row is not None and now - row[0] < self.gc_interval:
+				return
+
+			# remove a batch of the expired hosts, their responses and the
+			# expired responses of the other hosts
+			hosts = db.execute('SELECT host FROM hosts WHERE expires < ? LIMIT ?', (now, self.gc_batch_size)).fetchall()
+			db.executemany('DELETE FROM responses WHERE host = ?', hosts)
+			db.executemany('DELETE FROM missing WHERE host = ?', hosts)
+			db.executemany('DELETE FROM hosts WHERE host = ?', hosts)
+			for table in ['responses', 'missing']:
+				db.execute('''
+					DELETE FROM %s WHERE rowid IN (
+						SELECT rowid FROM %s WHERE saved < ? LIMIT ?
+					)''' % (table, table), (now - self.max_age, self.gc_batch_size * 100))
+
+			# remove the bodies that are no longer used
+			db.execute('''
+				DELETE FROM bodies WHERE NOT EXISTS (
+					SELECT 1 FROM responses WHERE responses.body_md5 = bodies.md5
+				)''')
+
+			db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('last_gc', now))
+
+
+	def is_saved(self, host):
+		# check if there are responses saved for the host, which have
+		# not expired
+		row = self._read('SELECT expires FROM hosts WHERE host = ?', (host, ))
+		return row is not None and row[0] > time.time()
+
+
+	def save_host(self, host):
+		now = int(time.time())
+		with self._transaction() as db:
+			db.execute(
+				'INSERT OR REPLACE INTO hosts (host, saved, expires) VALUES (?, ?, ?)',
+				(host, now, now + self.max_age))
+
+
+	def load_response(self, host, url):
+		return self._read(
+			'SELECT id, body_md5, saved, response FROM responses WHERE host = ? AND url = ? AND saved >= ?',
+			(host, url, int(time.time()) - self.max_age))
+
+
+	def load_body(self, md5):
+		row = self._read('SELECT compressed, body FROM bodies WHERE md5 = ?', (md5, ))
+		if row is None:
+			return None
+
+		compressed, body = row
+		return zlib.decompress(body) if compressed else bytes(body)
+
+
+	def _compress(self, body):
+		if self.compression_level > 0:
+			compressed_body = zlib.compress(body, self.compression_level)
+
+			# small bodies might not get any smaller
+			if len(compressed_body) < len(body):
+				return 1, compressed_body
+
+		return 0, body
+
+
+	def save_response(self, host, url, response_id, body_md5, body, data):
+		# the body is None if it is already saved
+		if body is not None:
+			compressed, body = self._compress(body)
+
+		with self._transaction() as db:
+			if body is not None:
+				db.execute('INSERT OR IGNORE INTO bodies (md5, compressed, body) VALUES (?, ?, ?)', (body_md5, compressed, body))
+
+			db.execute(
+				'INSERT OR REPLACE INTO responses (host, url, saved, id, body_md5, response) VALUES (?, ?, ?, ?, ?, ?)',
+				(host, url, int(time.time()), response_id, body_md5, data))
+
+
+	def load_missing(self, host, url, min_saved):
+		# the status of a missing path, if it was saved after 'min_saved'.
+		# Failed requests saved by earlier versions of wig are left out
+		row = self._read(
+			'SELECT status FROM missing WHERE host = ? AND url = ? AND saved >= ? AND status > 0',
+			(host, url, min_saved))
+		return None if row is None else row[0]
+
+
+	def save_missing(self, host, url, status):
+		with self._transaction() as db:
+			db.execute(
+				'INSERT OR REPLACE INTO missing (host, url, status, saved) VALUES (?, ?, ?, ?)',
+				(host, url, status, int(time.time())))
+
+
+	def close(self):
+		# the database is opened again, if it is used after this
+		with self.lock:
+			if self.db is not None:
+				self.db.close()
+				self.db = None
+
+		with self.read_lock:
+			if self.reader is not None:
+				self.reader.close()
+				self.reader = None
+
+
+class CacheShard(object):
+	"""
+	A part of the urls of a Cache, with its own lock. Looking up a
+	url only uses its shard: its response, whether it is stale or
+	missing, and the counts of the lookups.
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+
+		# url -> (number, url, response). The number keeps the order in
+		# which the urls were added
+		self.entries = dict()
+
+		# url -> stale response, for the urls looked up in the cache
+		self.stale = dict()
+
+		# url -> (status, time) of the paths found missing. The status
+		# is 0 if the request failed
+		self.missing = dict()
+
+		# the number of lookups ('hits' and 'misses'), and the number
+		# of hits that are only found through the canonical url. The
+		# urls given to __setitem__ are kept for the latter
+		self.stats = Counter()
+		self.added_urls = set()
+
+
+class BodyShard(object):
+	"""
+	A part of the bodies of a Cache, by their md5, with its own lock.
+	Every shard moves its least recently used bodies out of memory once
+	they take more than its part of the memory of the cache.
+	"""
+
+	def __init__(self):
+		# a response can load its body while the lock is held
+		self.lock = threading.RLock()
+
+		# md5 -> raw body, shared by all the responses with that body.
+		# The most recently used bodies are last
+		self.bodies = OrderedDict()
+		self.memory = 0
+
+		# md5 -> {encoding -> decoded body}, shared by the responses with
+		# the body. They are only kept while the raw body is in memory
+		self.texts = defaultdict(dict)
+
+		# md5 -> {response id -> response}, the responses sharing a body
+		self.body_responses = defaultdict(dict)
+
+		# response id -> response, for the responses with a body in the
+		# shard. A response stored under several urls is loaded as one
+		# object
+		self.responses = dict()
+
+		# the md5s of the bodies that are in the database, and of the
+		# bodies that are in the temporary database
+		self.saved_bodies = set()
+		self.spilled_bodies = set()
+
+		# md5 -> body, for the bodies that are being written to the
+		# temporary database
+		self.spilling = dict()
+
 
 class Cache(queue.Queue):
 	"""
@@ -16,162 +465,611 @@ class Cache(queue.Queue):
 	resource is only made once.
 	To further limit the amount of requests, wig saves a copy of the cache
 	and will reuse it for scans run within 24 hours.
+
+	The saved responses are kept in a SQLite database in the cache dir
+	(see CacheDatabase), keyed by the host and the url. Responses are
+	written to it as they are added to the cache, and are read from it
+	the first time they are looked up.
+
+	Many urls return the same page, e.g. a soft 404 page. The bodies of
+	the responses are therefore stored once, keyed by their md5, both in
+	memory and in the database. The bodies of the saved responses are
+	loaded the first time they are used.
+
+	The writes to the database are queued, and done by a writer thread,
+	so the requests do not wait for them, e.g. while another wig process
+	holds the write lock. 'save' and 'close' wait for the queued writes.
+
+	Saved responses older than 'cache_ttl' are stale. They are not in
+	the cache, but the requester can revalidate them with conditional
+	requests (see 'get_stale').
+
+	At most 'max_memory' bytes of bodies, raw and decoded, are kept in
+	memory. When there are more, the least recently used bodies are
+	moved out of memory, and the responses load them again when they
+	are used (see Response.unload_body). The responses do not keep
+	copies of the bodies, only their checksums. Bodies that are not in
+	the database are moved to a temporary database.
+
+	The urls are spread over 'shard_count' shards (see CacheShard), and
+	the bodies over as many shards by their md5 (see BodyShard), each
+	with its own lock, so the threads of the requester seldom wait for
+	each other. Every body shard has its part of 'max_memory', and its
+	own least recently used order. The locks are never held while a
+	database is used: a body is read from a database and decompressed,
+	or written to the temporary database, without them. 'lock' only
+	guards the state of the database and the writer thread.
+	get_urls and get_responses return snapshots, in the order the urls
+	were added, so they can be used while responses are still added.
+	The last snapshot is reused until the cache changes.
+
+	The paths found missing are kept apart from the responses, with the
+	status of the response and the time it was received. Within
+	'missing_ttl' seconds, the requester does not probe them again, in
+	this scan nor in the next ones (see get_missing). The window can be
+	longer than 'cache_ttl', but not than 'cache_max_age'. The paths of
+	the requests that failed, e.g. by a timeout, are only remembered for
+	this scan, as the next request might succeed.
+
+	The urls are stored and looked up by their canonical form (see
+	canonical_url), so e.g. '/a/../b?y=2&x=1' finds the response of
+	'/b?x=1&y=2'.
 	"""
 
+	shard_count = 16
+
 	def _init(self, maxsize):
-		self.queue = dict()
+		# the urls, and the bodies by their md5, are spread over
+		# 'shard_count' shards each (see CacheShard and BodyShard)
+		self.shards = [CacheShard() for _ in range(self.shard_count)]
+		self.body_shards = [BodyShard() for _ in range(self.shard_count)]
+		self.counter = itertools.count()
+
+		# the version is changed every time a url is added
+		self.versions = itertools.count()
+		self.version = next(self.versions)
+		self.snapshot = (None, [])
 		self.host = None
+
+		# guards the state of the database and the writer thread
+		self.lock = threading.RLock()
+
+		# the bytes of bodies, raw and decoded, kept in memory. Every
+		# body shard can use its part of them
+		self.max_memory = 256*1024*1024
+
+		# the temporary database, which is only used while holding
+		# spill_lock
+		self.spill_lock = threading.Lock()
+
 		self.cache_dir = './cache/'
-		self.cache_name = ''
-		self.now = str(time.time()).split('.')[0]
+		self.cache_file = os.path.join(self.cache_dir, 'cache.db')
+		self.now = int(time.time())
 		self.printer = None
 
 		# only load cache data that is new than this
 		# (currently this is set for 24 hours)
 		self.cache_ttl = 60*60*24
 
-		# check if cache dir exists - create if not
-		self._check_or_create_cache()
+		# older cache data is kept for 30 days to be revalidated
+		self.cache_max_age = 60*60*24*30
+
+		# paths found missing are not probed again for this long
+		self.missing_ttl = 60*60*24
+
+		# the database is opened when it is first needed. The temporary
+		# database is created when it is first needed
+		self.database = CacheDatabase(self.cache_file, self.cache_max_age)
+		self.spill_db = None
+
+		# look up responses in the database, and write new responses to it
+		self.is_loading = False
+		self.is_saving = False
 
-		# check if there are caches that are older than ttl
-		self._remove_old_caches()
+		# (function, args) of the writes to the database, done by the
+		# writer thread, which is started by the first write
+		self.writes = queue.Queue()
+		self.writer = None
+
+		# if the host had no saved responses when the cache was loaded,
+		# check again now and then, as another wig process might be
+		# scanning the host
+		self.load_requested = False
+		self.last_load_check = 0
+		self.load_check_interval = 5
 
 
 	def __getitem__(self, path):
-		return self.queue[path]
+		url = canonical_url(path)
+		response = self._get(url)
+		if response is None:
+			response = self._load_response(url)
+			if response is None:
+				raise KeyError(path)
+			response = self._add(url, response)
+
+		return response
 
 
 	def __setitem__(self, path, response):
-		with self.mutex:
-			self.queue[path] = response
+		url = canonical_url(path)
+		shard = self._get_shard(url)
+		with shard.lock:
+			shard.added_urls.add(path)
+
+		self._add(url, response, replace=True)
+		if self.is_saving:
+			self._write(self._save_response, url, response)
+
+
+	def __contains__(self, path):
+		url = canonical_url(path)
+		is_found = self._get(url) is not None
+		if not is_found:
+			response = self._load_response(url)
+			if response is not None:
+				self._add(url, response)
+				is_found = True
+
+		shard = self._get_shard(url)
+		with shard.lock:
+			if not is_found:
+				shard.stats['misses'] += 1
+			else:
+				shard.stats['hits'] += 1
+				# the response was added for another spelling of the url
+				if not path == url and path not in shard.added_urls:
+					shard.stats['canonical_hits'] += 1
+
+		return is_found
+
+
+	def _qsize(self):
+		return sum(len(shard.entries) for shard in self.shards)
+
+
+	def _get_shard(self, url):
+		return self.shards[hash(url) % self.shard_count]
+
+
+	def _get_body_shard(self, md5):
+		return self.body_shards[hash(md5) % self.shard_count]
+
 
+	def _get(self, url):
+		shard = self._get_shard(url)
+		with shard.lock:
+			entry = shard.entries.get(url)
 
-	def __contains__(self, url):
-		with self.mutex:
-			return url in self.queue
+		return None if entry is None else entry[2]
 
 
-	def _check_or_create_cache(self):
-		if not os.path.exists(self.cache_dir):
-			os.makedirs(self.cache_dir)
+	def _add(self, url, response, replace=False):
+		# add a response, and return the response stored for the url. A
+		# response loaded from the database does not replace a response
+		# added by another thread in the meantime
+		body_shard = self._get_body_shard(response.md5)
+		spilled = []
+		with body_shard.lock:
+			# two threads might have loaded the same response
+			response = body_shard.responses.setdefault(response.id, response)
 
+			if response.is_body_unloaded():
+				body_shard.body_responses[response.md5][response.id] = response
+				response.share_body(self)
 
-	def _remove_old_caches(self):
-		# remove caches that are too old
+			elif response.raw_body is not None:
+				if response.md5 not in body_shard.bodies:
+					body_shard.bodies[response.md5] = response.raw_body
+					body_shard.memory += len(response.raw_body)
 
-		# bail if the directory does not exist
-		if not os.path.exists(self.cache_dir):
+				body_shard.bodies.move_to_end(response.md5)
+				response.raw_body = body_shard.bodies[response.md5]
+				body_shard.body_responses[response.md5][response.id] = response
+				response.share_body(self)
+				spilled = self._evict(body_shard)
+
+		self._spill(body_shard, spilled)
+
+		shard = self._get_shard(url)
+		with shard.lock:
+			entry = shard.entries.get(url)
+			if entry is None:
+				shard.entries[url] = (next(self.counter), url, response)
+			elif replace:
+				shard.entries[url] = (entry[0], url, response)
+			else:
+				return entry[2]
+
+			self.version = next(self.versions)
+
+		return response
+
+
+	def _get_entries(self):
+		# a snapshot of the (number, url, response) entries in the cache
+		version, entries = self.snapshot
+		if version == self.version:
+			return entries
+
+		version = self.version
+		entries = []
+		for shard in self.shards:
+			with shard.lock:
+				entries.extend(shard.entries.values())
+
+		entries.sort(key=operator.itemgetter(0))
+		self.snapshot = (version, entries)
+		return entries
+
+
+	def _evict(self, body_shard):
+		# move the least recently used bodies of the shard out of memory.
+		# The most recently used body is kept, even if it is too big.
+		# Returns the bodies to write to the temporary database (see _spill)
+		max_memory = self.max_memory / self.shard_count
+		spilled = []
+		while body_shard.memory > max_memory and len(body_shard.bodies) > 1:
+			md5, body = body_shard.bodies.popitem(last=False)
+			body_shard.memory -= len(body)
+			for text in body_shard.texts.pop(md5, {}).values():
+				body_shard.memory -= sys.getsizeof(text)
+
+			if md5 not in body_shard.saved_bodies and md5 not in body_shard.spilled_bodies and md5 not in body_shard.spilling:
+				body_shard.spilling[md5] = body
+				spilled.append((md5, body))
+
+			for response in body_shard.body_responses[md5].values():
+				response.unload_body(self._get_body)
+
+		return spilled
+
+
+	def _spill(self, body_shard, bodies):
+		# write the bodies that are not in the database to the temporary
+		# database, without holding the lock of the shard. Until they
+		# are written, they are loaded from 'spilling'
+		if len(bodies) == 0:
+			return
+
+		with self.spill_lock:
+			self._get_spill_db().executemany('INSERT OR IGNORE INTO bodies (md5, body) VALUES (?, ?)', bodies)
+
+		with body_shard.lock:
+			for md5, body in bodies:
+				body_shard.spilled_bodies.add(md5)
+				body_shard.spilling.pop(md5, None)
+
+
+	def _get_body(self, md5):
+		# load a body that has been moved out of memory. The database is
+		# read, and the body decompressed, without holding the lock
+		body_shard = self._get_body_shard(md5)
+		with body_shard.lock:
+			body = body_shard.bodies.get(md5)
+			if body is None:
+				body = body_shard.spilling.get(md5)
+			is_spilled = md5 in body_shard.spilled_bodies
+
+		if body is None and is_spilled:
+			with self.spill_lock:
+				row = self.spill_db.execute('SELECT body FROM bodies WHERE md5 = ?', (md5, )).fetchone()
+			body = None if row is None else row[0]
+
+		elif body is None:
+			body = self.database.load_body(md5)
+
+		if body is None:
 			return None
 
-		# iterate over the cache files
-		for cache_file in os.listdir(self.cache_dir):
+		with body_shard.lock:
+			# another thread might have loaded the body in the meantime
+			if md5 not in body_shard.bodies:
+				body_shard.bodies[md5] = body
+				body_shard.memory += len(body)
+				for response in body_shard.body_responses[md5].values():
+					response.raw_body = body
+
+			body_shard.bodies.move_to_end(md5)
+			body = body_shard.bodies[md5]
+			spilled = self._evict(body_shard)
+
+		self._spill(body_shard, spilled)
+		return body
+
+
+	def get_text(self, md5, encoding, decode):
+		# get the decoded body of the responses with the md5. It is
+		# decoded with 'decode' by the first response that uses it
+		body_shard = self._get_body_shard(md5)
+		with body_shard.lock:
+			text = body_shard.texts[md5].get(encoding) if md5 in body_shard.texts else None
+			if text is not None:
+				body_shard.bodies.move_to_end(md5)
+				return text
+
+		text = decode()
+		with body_shard.lock:
+			# another thread might have decoded the body in the meantime,
+			# or the raw body might have been moved out of memory
+			spilled = []
+			if md5 in body_shard.bodies and encoding not in body_shard.texts[md5]:
+				body_shard.texts[md5][encoding] = text
+				body_shard.memory += sys.getsizeof(text)
+				body_shard.bodies.move_to_end(md5)
+				spilled = self._evict(body_shard)
 
-			# skip the file if it's not a cache file
-			if not cache_file.endswith('.cache'):
-				continue
+			elif md5 in body_shard.bodies:
+				text = body_shard.texts[md5][encoding]
 
-			# check if the cache is for the host
-			_, time_ext = cache_file.split('_-_')
-			save_time, _ = time_ext.split('.')
+		self._spill(body_shard, spilled)
+		return text
 
-			# check the age of the cache, and remove it if older than
-			# ttl
-			age = int(self.now) - int(save_time)
-			if age > self.cache_ttl:
-				file_name = os.path.join(self.cache_dir, cache_file)
-				os.remove(file_name)
 
+	def _get_spill_db(self):
+		# an empty name creates a temporary database, which is deleted
+		# when it is closed
+		if self.spill_db is None:
+			self.spill_db = sqlite3.connect('', check_same_thread=False)
+			self.spill_db.execute('CREATE TABLE bodies (md5 TEXT PRIMARY KEY, body BLOB NOT NULL)')
 
-	def _get_name_for_cache_file(self):
-		# check if there already is an older version of the cache
-		# if there is, return the name of this file.
-		# it will be overwritten
-		if not os.path.exists(self.cache_dir):
-			os.makedirs(self.cache_dir)
+		return self.spill_db
 
-		for cache_file in os.listdir(self.cache_dir):
-			# skip the file if it's not a cache file
-			if not cache_file.endswith('.cache'):
-				continue
 
-			# check if the cache is for the host
-			hostname, _ = cache_file.split('_-_')
-			if hostname == self.cache_name.split('_-_')[0]:
-				return os.path.join(self.cache_dir, cache_file)
+	def _load_response(self, url):
+		if not self.is_loading:
+			if not self.load_requested or time.time() - self.last_load_check < self.load_check_interval:
+				return None
 
-		# if there aren't any previous cache files, generate a
-		# new name for the cache
-		return os.path.join(self.cache_dir, self.cache_name)
+			self._check_host()
+			if not self.is_loading:
+				return None
+
+		try:
+			row = self.database.load_response(self.host, url)
+			if row is None:
+				return None
+
+			response_id, md5, saved, data = row
+			body_shard = self._get_body_shard(md5)
+			with body_shard.lock:
+				if response_id in body_shard.responses:
+					return body_shard.responses[response_id]
+
+			# the body is loaded when it is used
+			response = pickle.loads(data)
+			if md5 is not None:
+				response.unload_body(self._get_body)
+
+			if md5 is not None:
+				with body_shard.lock:
+					body_shard.saved_bodies.add(md5)
+
+			if saved < self.now - self.cache_ttl:
+				shard = self._get_shard(url)
+				with shard.lock:
+					shard.stale[url] = response
+				return None
+
+			return response
+
+		except Exception as err:
+			if self.printer:
+				self.printer.print_debug_line('Error loading %s from cache' % (url, ), 1)
+
+			return None
+
+
+	def _write(self, function, *args):
+		with self.lock:
+			if self.writer is None:
+				self.writer = threading.Thread(target=self._run_writer, daemon=True)
+				self.writer.start()
+
+		self.writes.put((function, args))
+
+
+	def _run_writer(self):
+		while True:
+			write = self.writes.get()
+			try:
+				if write is None:
+					return
+
+				function, args = write
+				function(*args)
+
+			# a failed write must not stop the writer, as 'save' waits
+			# for the writes queued after it
+			except Exception as err:
+				if self.printer:
+					self.printer.print_debug_line('Error writing to cache: %s' % (err, ), 1)
+
+			finally:
+				self.writes.task_done()
+
+
+	def _stop_writer(self):
+		# wait for the queued writes, and stop the writer thread
+		with self.lock:
+			writer, self.writer = self.writer, None
+
+		if writer is not None:
+			self.writes.put(None)
+			writer.join()
+
+
+	def _save_response(self, url, response):
+		# the body is saved separately. A body that is not in memory is
+		# already saved
+		has_body = response.is_body_unloaded() or response.raw_body is not None
+		body_md5 = response.md5 if has_body else None
+		stored = copy.copy(response)
+		stored.raw_body = None
+
+		body_shard = self._get_body_shard(body_md5)
+		with body_shard.lock:
+			needs_body = has_body and body_md5 not in body_shard.saved_bodies
+
+		# this can load the body from the temporary database
+		body = response.raw_body if needs_body else None
+
+		try:
+			self.database.save_response(self.host, url, response.id, body_md5, body, pickle.dumps(stored))
+		except Exception as err:
+			if self.printer:
+				self.printer.print_debug_line('Error saving %s to cache' % (url, ), 1)
+			return
+
+		if has_body:
+			with body_shard.lock:
+				body_shard.saved_bodies.add(body_md5)
 
 
 	def set_host(self, host):
-		self.host = host
-		self.cache_name = self.host.replace('/', '').replace(':', '..') + '_-_' + self.now + '.cache'
+		# 'http://example.com' and 'http://example.com/' are the same host
+		self.host = host.rstrip('/')
+
+
+	def get_stale(self, url):
+		# get the stale response for a url, which was not found in the
+		# cache. If the response is still valid, it should be added to
+		# the cache again
+		url = canonical_url(url)
+		shard = self._get_shard(url)
+		with shard.lock:
+			return shard.stale.pop(url, None)
+
+
+	def add_missing(self, url, status):
+		# record that a path does not exist, or could not be requested.
+		# A failed request (status 0) is not saved for the next scans
+		url = canonical_url(url)
+		shard = self._get_shard(url)
+		with shard.lock:
+			shard.missing[url] = (status, int(time.time()))
+
+		if self.is_saving and status > 0:
+			self._write(self._save_missing, url, status)
+
+
+	def _save_missing(self, url, status):
+		try:
+			self.database.save_missing(self.host, url, status)
+		except Exception as err:
+			if self.printer:
+				self.printer.print_debug_line('Error saving %s to cache' % (url, ), 1)
+
+
+	def get_missing(self, url):
+		# get the status of a path found missing within 'missing_ttl'
+		# seconds, or None if it should be probed
+		if self.missing_ttl <= 0:
+			return None
+
+		url = canonical_url(url)
+		min_saved = int(time.time()) - self.missing_ttl
+		shard = self._get_shard(url)
+		with shard.lock:
+			status, saved = shard.missing.get(url, (None, 0))
+
+		if status is None and self.is_loading:
+			try:
+				status = self.database.load_missing(self.host, url, min_saved)
+				saved = min_saved
+			except Exception as err:
+				if self.printer:
+					self.printer.print_debug_line('Error loading %s from cache' % (url, ), 1)
+
+		if status is None or saved < min_saved:
+			return None
+
+		with shard.lock:
+			shard.stats['missing_hits'] += 1
+
+		return status
 
 
 	def get_num_urls(self):
-		return len(set([self.queue[key].id for key in self.queue]))
+		return len(set([response.id for _, url, response in self._get_entries()]))
 
 
 	def get_urls(self):
-		return [k for k in self.queue]
+		return [url for _, url, response in self._get_entries()]
 
 
 	def get_responses(self):
-		return [self.queue[key] for key in self.queue]
+		return [response for _, url, response in self._get_entries()]
+
+
+	def get_stats(self):
+		# the counts of the shards, summed
+		stats = Counter()
+		for shard in self.shards:
+			with shard.lock:
+				stats.update(shard.stats)
+
+		return dict(stats)
+
+
+	def enable_saving(self):
+		# write the responses for the host to the database as they are
+		# added. The responses that are already in the cache are written now
+		if self.host is None:
+			return None
+
+		try:
+			self.database.save_host(self.host)
+		except Exception as err:
+			if self.printer:
+				self.printer.print_debug_line('Error saving cache', 1)
+			return
+
+		self.is_saving = True
+		for _, path, response in self._get_entries():
+			self._write(self._save_response, path, response)
 
 
 	def save(self):
-		# save the queue for later use
+		# the responses are written to the database as they are added.
 		# this will help limit the amount of requests made
 		# when scanning the same site multiple times
-		with self.mutex:
-			file_name = self._get_name_for_cache_file()
-			with open(file_name, 'wb') as cache_file:
-				try:
-					pickle.dump(self.queue, cache_file)
-				except Exception as err:
-					if self.printer:
-						self.printer.print_debug_line('Error saving cache', 1)
-				else:
-					if self.printer:
-						self.printer.print_debug_line('Saved cache to: %s' % (file_name, ), 1)
-
+		self.writes.join()
+		if self.printer and self.is_saving:
+			self.printer.print_debug_line('Saved cache to: %s' % (self.cache_file, ), 1)
 
 
 	def load(self):
-		# loads previously saved cache for the host
+		# use the previously saved cache for the host. The responses
+		# are loaded when they are looked up
 
 		# bail if the host is not set
 		if self.host is None:
 			return None
 
-		# search the cache dir
-		for cache_file in os.listdir(self.cache_dir):
+		self.load_requested = True
+		self._check_host()
+		if self.printer and self.is_loading:
+			self.printer.print_debug_line('Loading cache from: %s' % (self.cache_file, ), 1)
 
-			# skip the file if it's not a cache file
-			if not cache_file.endswith('.cache'):
-				continue
 
-			# check if the cache is for the host
-			hostname, time_ext = cache_file.split('_-_')
-			save_time, _ = time_ext.split('.')
+	def _check_host(self):
+		# check if there are saved responses for the host
+		self.last_load_check = time.time()
+		try:
+			self.is_loading = self.database.is_saved(self.host)
+		except Exception as err:
+			if self.printer:
+				self.printer.print_debug_line('Error loading cache', 1)
 
-			# calc the age of the cache
-			age = int(self.now) - int(save_time)
 
-			# overwrite the current queue if it's for the host and the cache is not too old
-			if hostname == self.cache_name.split('_-_')[0] and age < self.cache_ttl:
-				file_name = os.path.join(self.cache_dir, cache_file)
-				try:
-					with open(file_name, 'rb') as handle:
-						data = pickle.load(handle)
-						for path in data:
-							self.__setitem__(path, data[path])
-				except:
-					if self.printer:
-						self.printer.print_debug_line('Error loading cache', 1)
-				else:
-					if self.printer:
-						self.printer.print_debug_line('Loaded cache from: %s' % (cache_file, ), 1)
+	def close(self):
+		# stop using the database. It is closed by its owner, as it can be
+		# used by the next cache. The temporary database is kept, as the
+		# responses might still load their bodies from it
+		with self.lock:
+			self.load_requested = False
+			self.is_loading = False
+			self.is_saving = False
 
+		self._stop_writer()
@@ -3,13 +3,17 @@ Collection of classes to extract information from the site.
 
 """
 
+import contextlib
 import re
 import socket
 import urllib
+import urllib.parse
 import urllib.request
 from collections import Counter, defaultdict
 from html.parser import HTMLParser
 
+from classes.cache import canonical_url
+
 class DiscoverAllCMS:
     """
     Match all fingerprints against all responses
@@ -32,6 +36,7 @@ class DiscoverAllCMS:
         for fp_category in ['cms', 'platform']:
             for fp_type in self.fps.data[fp_category]:
                 fps = self.fps.data[fp_category][fp_type]['fps']
+                fps = self.matcher.get_index((fp_category, fp_type), fps)
 
                 for response in self.cache.get_responses():
                     matches = self.matcher.get_result(fps, response)
@@ -44,17 +49,131 @@ class DiscoverAllCMS:
                         self.tmp_set.add((fp['name'], fp['output']))
 
 
+# Used by DiscoverCMS to find the version of a CMS
+class VersionResolver:
+    """
+    Chooses the urls to request to find the version of a CMS.
+
+    The md5 fingerprints of a CMS tell which md5 each version has at a
+    url. Instead of requesting every url of the CMS, only the urls that
+    can still rule out a version are requested, in rounds of
+    'round_size' urls. In each round, the urls that split the possible
+    versions best are taken first.
+
+    Two sets of versions are kept:
+    - the candidates, which have the md5 of every response that
+      matched. These are the versions with the highest score in Results
+    - the possible versions, the candidates that are not ruled out by a
+      url that did not match, even though they have an md5 for it.
+      These are only used to choose between the urls, as a changed
+      file also rules out the version of the site
+
+    A url is requested if a response with the md5 a candidate has at
+    the url would remove another candidate. Once no url can, the
+    version found is the same as if all the urls had been requested,
+    also if files of the site are missing. This does not hold if the
+    site has files from different versions, e.g. after a partial
+    upgrade: the versions can differ from an exhaustive scan (see
+    bench/bench_cms_versions.py). If no version is left, i.e. the
+    responses match different versions, all the remaining urls are
+    requested.
+
+    The urls with other fingerprints than md5 fingerprints of versions
+    are always requested.
+    """
+
+    round_size = 4
+
+    def __init__(self, fps_by_url):
+        self.fps_by_url = fps_by_url
+
+        # url -> version -> md5, and the urls that are always requested
+        self.md5s = defaultdict(dict)
+        self.always = set()
+        for url, fps in fps_by_url.items():
+            for fp in fps:
+                if fp.get('type') == 'md5' and fp['output'] != '' and not 'header' in fp and not 'code' in fp:
+                    self.md5s[url].setdefault(fp['output'], fp['match'])
+                else:
+                    self.always.add(url)
+
+        self.candidates = set(version for md5s in self.md5s.values() for version in md5s)
+        self.possible = set(self.candidates)
+
+        # the urls that have not been requested
+        self.remaining = set(fps_by_url)
+
+
+    def add_result(self, url, matches):
+        # matches are the fingerprints of the CMS that matched the
+        # response, or None if the response is not known
+        self.remaining.discard(url)
+        if matches is None or url not in self.md5s:
+            return
+
+        versions = set(fp['output'] for fp in matches if fp.get('type') == 'md5' and fp['output'] in self.md5s[url])
+        if len(versions) > 0:
+            self.candidates &= versions
+            self.possible &= versions
+        else:
+            self.possible -= set(self.md5s[url])
+
+
+    def _can_narrow(self, url):
+        md5s = self.md5s.get(url)
+        if not md5s:
+            return False
+
+        # the number of candidates that have each md5 at the url. The
+        # possible versions are not used here, as a changed file rules
+        # out the version of the site
+        counts = Counter(md5s.get(version) for version in self.candidates)
+        return any(version in md5s and counts[md5s[version]] < len(self.candidates) for version in self.candidates)
+
+
+    def _get_cost(self, url, splits):
+        # the sum of the squared sizes of the groups of versions that
+        # the chosen urls and the url tell apart
+        counts = Counter(splits[version] + (self.md5s[url].get(version), ) for version in splits)
+        return sum(count*count for count in counts.values())
+
+
+    def get_queue(self):
+        # the fingerprint lists to request in the next round
+        urls = [url for url in self.fps_by_url if url in self.remaining]
+        if len(self.candidates) > 0:
+            chosen = [url for url in urls if url in self.always]
+            urls = [url for url in urls if url not in self.always and self._can_narrow(url)]
+
+            # version -> its md5s at the chosen urls
+            splits = {version: () for version in (self.possible or self.candidates)}
+            while len(urls) > 0 and len(chosen) < self.round_size:
+                url = min(urls, key=lambda url: self._get_cost(url, splits))
+                urls.remove(url)
+                chosen.append(url)
+                for version in splits:
+                    splits[version] += (self.md5s[url].get(version), )
+
+            urls = chosen
+
+        self.remaining.difference_update(urls)
+        return [self.fps_by_url[url] for url in urls]
+
+
 class DiscoverCMS:
     """
     Search for the CMS and its version.
 
-    It searches for a CMS match by splitting the fingerprints
-    into batches of the given size (options['batch_size']).
-    One a batch of fingerprints urls have been requested, the
-    responses are checked for CMS matches. If a match is found,
-    all the URLs for that CMS are requested in order to determine
-    the version. If options['run_all'] is set, this continues until
-    all fingerprints are checked (this is not the default).
+    The fingerprint urls are requested as a stream (see
+    Requester.stream), and each response is checked for CMS
+    matches as soon as it arrives. If a match is found, the URLs
+    for that CMS that can narrow down its version are requested (see
+    VersionResolver), or all of them if
+    options['exhaustive_versions'] is set. Once options['stop_after'] CMSs have been detected,
+    no more URLs are requested, and the outstanding requests are
+    cancelled, except those for the detected CMSs. If
+    options['run_all'] is set, this continues until all
+    fingerprints are checked (this is not the default).
 
     """
     def __init__(self, options, data):
@@ -64,126 +183,143 @@ class DiscoverCMS:
         self.result = data['results']
         self.printer = data['printer']
 
-        self.batch_size = options['batch_size']
         self.num_cms_to_find = options['stop_after']
         self.find_all_cms = options['run_all']
 
         # only used for pretty printing of debugging info
         self.tmp_set = set()
 
-        self.queue = defaultdict(list)
-        for fp_type in data['fingerprints'].data['cms']:
-            for fp in data['fingerprints'].data['cms'][fp_type]['fps']:
-                self.queue[fp['url']].append(fp)
+        # url -> fps, and cms -> url -> fps
+        self.url_index = data['fingerprints'].get_url_index('cms')
+        self.cms_index = data['fingerprints'].get_name_index('cms')
 
+        # the urls that are left to request, the last one first, and the
+        # urls that have been requested. The urls most likely to identify
+        # the CMS are requested first (see fingerprints.get_probe_order).
+        # The fingerprints of a CMS that have been taken by get_queue(cms)
+        # are not requested again
+        self.urls = list(reversed(data['fingerprints'].get_probe_order('cms')))
+        self.requested_urls = set()
+        self.taken_cms = set()
 
-    def get_queue(self, cms=None):
-        queue = []
-        if cms is None:
-            for _ in range(self.batch_size):
-                try:
-                    url, fp_list = self.queue.popitem()
-                    queue.append(fp_list)
-                except KeyError:
-                    break
-        else:
-            # the following procedure is *not* optimal
-            # the self.queue dict is completely destroyed and
-            # and rebuilt each time this procedure is called :(
-
-            # create a temp queue dict
-            tmp_queue = defaultdict(list)
-
-            # remove elements from the dict until it is empty
-            while len(self.queue) > 0:
-                url, fp_list = self.queue.popitem()
-
-                # remove all the elements of a queue entry's list
-                # one-by-one and check if the fingerprints are
-                # belong to the specified 'cms'
-                tmp_list, out_list = [], []
-
-                while len(fp_list) > 0:
-                    # remove the fingerprint
-                    fp = fp_list.pop()
-
-                    # if the fingerprint matches the cms, add it to the
-                    # out_list for the current url
-                    # otherwise add it to the tmp_list
-                    if fp['name'] == cms:
-                        out_list.append(fp)
-                    else:
-                        tmp_list.append(fp)
+        # url -> the fingerprints that matched the response to the url
+        self.matches = {}
+
+        # request all the urls of a cms to find its version, instead of
+        # only the ones that can narrow it down (see VersionResolver)
+        self.exhaustive_versions = options['exhaustive_versions']
+
+
+    def iter_queue(self, is_stopped=lambda: False):
+        # the fingerprint lists are taken from the queue as they are
+        # requested, so the fingerprints taken by get_queue(cms) in the
+        # meantime are left out. Nothing more is taken once is_stopped()
+        while len(self.urls) > 0 and not is_stopped():
+            url = self.urls.pop()
+            self.requested_urls.add(url)
 
-                # if there are elements in tmp_list (the new list of fps that
-                # that do *not* match the 'cms'), add it to the tmp_queue's entry
-                # for the current url
-                if len(tmp_list) > 0:
-                    tmp_queue[url].extend(tmp_list)
+            fp_list = [fp for fp in self.url_index[url] if fp['name'] not in self.taken_cms]
+            if len(fp_list) > 0:
+                yield fp_list
 
-                # if matches for the specified cms have been found, add the list
-                # to the fingerprintQueue for the requester
-                if len(out_list) > 0:
-                    queue.append(out_list)
 
-            # replace the queue with the tmp queue
-            self.queue = tmp_queue
+    def get_queue(self, cms):
+        # the fingerprints of the cms, for the urls that have not been
+        # requested yet. This only goes through the fingerprints of the cms
+        self.taken_cms.add(cms)
+
+        queue = []
+        for url, fp_list in self.cms_index.get(cms, {}).items():
+            if url not in self.requested_urls:
+                queue.append(fp_list)
 
         return queue
 
 
-    def run(self):
-        batch_no = 0
-        self.printer.print_debug_line('Determining CMS type ...', 1)
+    def add_versions(self, results, resolver=None):
+        while results.qsize() > 0:
+            res_fps, response = results.get()
+            matches = self.matcher.get_result(res_fps, response)
+            for fp in matches:
+                self.result.add('cms', fp['name'], fp['output'], fp)
 
-        detected_cms = []
-        stop_searching = len(detected_cms) >= self.num_cms_to_find
+                if (fp['name'], fp['output']) not in self.tmp_set:
+                    self.tmp_set.add((fp['name'], fp['output']))
+                    self.printer.print_debug_line('- Found version: %s %s' % (fp['name'], fp['output']), 2)
 
-        while (not stop_searching or self.find_all_cms) and (not len(self.queue) == 0):
-            self.printer.print_debug_line('Checking fingerprint group no. %s ...' % (batch_no, ), 3)
+            if resolver is not None:
+                resolver.add_result(res_fps[0]['url'], matches)
 
-            # set the requester queue
-            results = self.requester.run('CMS', self.get_queue())
 
-            # search for CMS matches
-            cms_matches = []
-            while not results.empty():
-                fingerprints, response = results.get()
+    def find_version(self, cms):
+        self.printer.print_debug_line('Determining CMS version ...', 1)
 
-                for fp in self.matcher.get_result(fingerprints, response):
-                    self.result.add('cms', fp['name'], fp['output'], fp)
-                    cms_matches.append(fp['name'])
+        # request all the fingerprints for the cms
+        if self.exhaustive_versions:
+            self.add_versions(self.requester.run('CMS_version', self.get_queue(cms)))
+            return
+
+        # or only the ones that can narrow down the version, starting
+        # from the responses to the urls requested while searching for
+        # the cms. As with get_queue(cms), the urls still being
+        # requested are left out, as their responses are matched by run()
+        self.taken_cms.add(cms)
+        resolver = VersionResolver(self.cms_index.get(cms, {}))
+        for url in self.cms_index.get(cms, {}):
+            if url in self.requested_urls:
+                matches = self.matches.get(url)
+                resolver.add_result(url, None if matches is None else [fp for fp in matches if fp['name'] == cms])
+
+        queue = resolver.get_queue()
+        while len(queue) > 0:
+            self.add_versions(self.requester.run('CMS_version', queue), resolver)
+            queue = resolver.get_queue()
 
-            # search for the found CMS versions
-            for cms in cms_matches:
 
-                # skip checking the cms, if it has already been detected
-                if cms in detected_cms: continue
+    def run(self):
+        self.printer.print_debug_line('Determining CMS type ...', 1)
 
-                if cms not in self.tmp_set:
-                    self.tmp_set.add(cms)
-                    self.printer.print_debug_line('- Found CMS match: %s' % (cms, ), 2)
+        if self.num_cms_to_find <= 0 and not self.find_all_cms:
+            return
 
-                # set the requester queue with only fingerprints for the cms
-                results = self.requester.run('CMS_version', self.get_queue(cms))
+        detected_cms = []
 
-                # find the results
-                self.printer.print_debug_line('Determining CMS version ...', 1)
-                while results.qsize() > 0:
-                    res_fps, response = results.get()
-                    for fp in self.matcher.get_result(res_fps, response):
-                        self.result.add('cms', fp['name'], fp['output'], fp)
+        # once enough CMSs have been found, no more urls are requested,
+        # and the requests still in flight are only kept if they have
+        # fingerprints of a detected CMS. These urls are left out by
+        # find_version, as they have already been requested, so their
+        # responses are needed for its version
+        def is_stopped():
+            return len(detected_cms) >= self.num_cms_to_find and not self.find_all_cms
 
-                        if (fp['name'], fp['output']) not in self.tmp_set:
-                            self.tmp_set.add((fp['name'], fp['output']))
-                            self.printer.print_debug_line('- Found version: %s %s' % (fp['name'], fp['output']), 2)
+        def cancel(fp_list):
+            return is_stopped() and not any(fp['name'] in detected_cms for fp in fp_list)
+
+        with contextlib.closing(self.requester.stream('CMS', self.iter_queue(is_stopped), cancel=cancel)) as results:
+            for fingerprints, response in results:
+
+                # only the versions of the detected CMSs are searched for
+                # in the responses that arrive after the search has stopped
+                if is_stopped():
+                    fingerprints = [fp for fp in fingerprints if fp['name'] in detected_cms]
+                    if len(fingerprints) == 0: continue
+
+                # search for CMS matches
+                matches = self.matcher.get_result(fingerprints, response)
+                self.matches[fingerprints[0]['url']] = matches
+                for fp in matches:
+                    self.result.add('cms', fp['name'], fp['output'], fp)
 
-                # update the stop criteria
-                detected_cms.append(cms)
+                    # skip checking the cms, if it has already been detected
+                    if fp['name'] in detected_cms: continue
 
-            stop_searching = (len(detected_cms) >= self.num_cms_to_find) or len(self.queue) == 0
-            batch_no += 1
+                    if fp['name'] not in self.tmp_set:
+                        self.tmp_set.add(fp['name'])
+                        self.printer.print_debug_line('- Found CMS match: %s' % (fp['name'], ), 2)
 
+                    # search for the found CMS version
+                    self.find_version(fp['name'])
+                    detected_cms.append(fp['name'])
 
 
 class DiscoverCookies(object):
@@ -311,7 +447,8 @@ class DiscoverErrorPage:
         error_pages = set()
         while results.qsize() > 0:
             fp, response = results.get()
-            if response is not None:
+            # the body of the response might not have been kept
+            if response is not None and response.md5_404 is not None:
                 error_pages.add(response.md5_404)
                 error_pages.add(response.md5_404_text)
                 error_tuple = (response.md5_404, response.md5_404_text, fp[0]['url'])
@@ -356,7 +493,7 @@ class DiscoverInteresting(object):
             # if the response includes a 404 md5, check if the response
             # is a redirection to a known error page
             # this is a fix for https://github.com/jekyc/wig/issues/7
-            if response is not None:
+            if response is not None and response.md5_404 is not None:
                 redirected = response.md5_404 in self.error_pages
                 redirected = redirected or (response.md5_404_text in self.error_pages)
                 redirected = redirected or (response.md5_404_text == self.cache[self.url].md5_404_text)
@@ -410,9 +547,7 @@ class DiscoverJavaScript(object):
         self.matcher = data['matcher']
         self.result = data['results']
 
-        self.fingerprints = []
-        for fp_type in data['fingerprints'].data['js']:
-            self.fingerprints.extend(data['fingerprints'].data['js'][fp_type]['fps'])
+        self.fingerprints = self.matcher.get_index('js', data['fingerprints'].get_all('js'))
 
 
     def run(self):
@@ -442,8 +577,10 @@ class LinkExtractor(HTMLParser):
     Only checks for img, script, and link tags
     """
 
-    def __init__(self, strict):
-        super().__init__(strict=strict)
+    def __init__(self):
+        # the 'strict' argument was removed from HTMLParser in Python 3.5,
+        # the parser is always lenient
+        super().__init__()
         self.results = set()
 
     def get_results(self):
@@ -501,8 +638,10 @@ class DiscoverMore(object):
 
     def run(self):
         self.printer.print_debug_line('Detecting links ...', 1)
-        resources = set()
-        parser = LinkExtractor(strict=False)
+        # canonical url -> url. Links that only differ in their spelling
+        # are fetched once
+        resources = dict()
+        parser = LinkExtractor()
 
         for req in self.cache.get_responses():
             # skip pages that do not set 'content-type'
@@ -527,7 +666,8 @@ class DiscoverMore(object):
                     # skip data urls
                     if url_data.path.startswith('data:'): continue
 
-                    resources.add(i)
+                    key = canonical_url(urllib.parse.urljoin(self.host, i))
+                    resources.setdefault(key, i)
 
         # the items in the resource set should mimic a list of fingerprints:
         # a fingerprint is a dict with at least an URL key
@@ -535,7 +675,7 @@ class DiscoverMore(object):
 
         # prepare the urls
         queue = defaultdict(list)
-        for url in resources:
+        for url in resources.values():
             queue[url].append({'url': url})
 
         # fetch'em
@@ -661,12 +801,9 @@ class DiscoverPlatform:
         self.result = data['results']
         self.printer = data['printer']
         self.threads = options['threads']
-        self.batch_size = options['batch_size']
         self.queue = defaultdict(list)
-
-        for fp_type in data['fingerprints'].data['platform']:
-            for fp in data['fingerprints'].data['platform'][fp_type]['fps']:
-                self.queue[fp['url']].append(fp)
+        for url, fps in data['fingerprints'].get_url_index('platform').items():
+            self.queue[url] = list(fps)
 
         # only used for pretty printing of debugging info
         self.tmp_set = set()
@@ -674,20 +811,9 @@ class DiscoverPlatform:
     def run(self):
         self.printer.print_debug_line('Detecting platform ...', 1)
 
-        while len(self.queue) > 0:
-            queue = []
-            for i in range(self.batch_size):
-                try:
-                    url, fp_list = self.queue.popitem()
-                    queue.append(fp_list)
-                except KeyError:
-                    break
-
-            results = self.requester.run('Plaform', queue)
-
-            # search for CMS matches
-            while not results.empty():
-                fingerprints, response = results.get()
+        # match the responses as they arrive (see Requester.stream)
+        with contextlib.closing(self.requester.stream('Plaform', self.queue.values())) as results:
+            for fingerprints, response in results:
                 matches = self.matcher.get_result(fingerprints, response)
                 for fp in matches:
                     self.result.add('platform', fp['name'], fp['output'], fp)
@@ -773,8 +899,8 @@ class DiscoverUrlLess:
 
         for fp_category in ['cms', 'platform']:
             for fp_type in self.fingerprints.data[fp_category]:
-                fps = self.fingerprints.data[fp_category][fp_type]['fps']
-                fps = [fp for fp in fps if fp['url'] == '']
+                fps = self.fingerprints.get_urlless(fp_category, fp_type)
+                fps = self.matcher.get_index((fp_category, fp_type, 'urlless'), fps)
 
                 # find matches for all the responses in the cache
                 for response in self.cache.get_responses():
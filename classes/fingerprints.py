@@ -1,11 +1,29 @@
 import json
 import os
 import copy
+import hashlib
+import heapq
+import mmap
+import pickle
+import struct
+from collections import defaultdict
+
+
+# the compiled fingerprint database. It is built from the JSON files in
+# 'data/' by FingerprintCompiler (wig.py --compile_fingerprints) and
+# is used instead of the JSON files if it is present and up to date.
+COMPILED_FILE = 'data/fingerprints.bin'
+
+# header: magic, format version, payload length, sha256 of the payload
+# and a sha1 signature of the JSON source files it was compiled from
+COMPILED_MAGIC = b'WIGFPDB\x00'
+COMPILED_VERSION = 5
+COMPILED_HEADER = struct.Struct('<8sIQ32s20s')
 
 
 class Fingerprints(object):
 
-	def __init__(self):
+	def __init__(self, compiled_file=COMPILED_FILE):
 		
 		self.data = {
 			'cms': {
@@ -34,13 +52,14 @@ class Fingerprints(object):
 			'os':				{'dir':  'data/os/',				'fps': []}
 		}
 
-		# load fingerprints
-		self._load_subdomains()
-		self._load_dictionary()
-		self._load_interesting()
-		self._load_error()
-		self._load_os()
-		self._load()
+		# indexes built from the fingerprints (see _build_indexes)
+		self.indexes = {}
+
+		# load the compiled fingerprints, and fall back to the
+		# JSON files if they are not available
+		self.compiled_file = compiled_file
+		if not self._load_compiled():
+			self._load_json()
 
 
 	def _is_json(self, filename):
@@ -115,3 +134,270 @@ class Fingerprints(object):
 					for fp in fps:
 						fp['name'] = self._get_name( json_file )
 						self.data[category][fp_type]['fps'].append( fp )
+
+
+	def _load_json(self):
+		self._load_subdomains()
+		self._load_dictionary()
+		self._load_interesting()
+		self._load_error()
+		self._load_os()
+		self._load()
+		self._build_indexes()
+
+
+	def _build_indexes(self):
+		# fingerprints grouped by url for each category. The order of
+		# the fingerprints is the same as the order they are loaded in
+		self.indexes['url'] = {}
+		for category in ['cms', 'js', 'platform']:
+			index = {}
+			for fp_type in self.data[category]:
+				for fp in self.data[category][fp_type]['fps']:
+					index.setdefault(fp['url'], []).append(fp)
+
+			self.indexes['url'][category] = index
+
+		# the same fingerprints grouped by name, and then by url, so the
+		# fingerprints of a single CMS can be found without going
+		# through the others
+		self.indexes['name'] = {}
+		for category in ['cms', 'js', 'platform']:
+			index = {}
+			for url, fps in self.indexes['url'][category].items():
+				for fp in fps:
+					index.setdefault(fp['name'], {}).setdefault(url, []).append(fp)
+
+			self.indexes['name'][category] = index
+
+		# the fingerprints without a url, which DiscoverUrlLess matches
+		# against all the responses. The lists are built once, so the
+		# matcher indexes them once instead of for every site
+		self.indexes['urlless'] = {}
+		for category in ['cms', 'platform']:
+			self.indexes['urlless'][category] = {
+				fp_type: [fp for fp in self.data[category][fp_type]['fps'] if fp['url'] == '']
+				for fp_type in self.data[category]
+			}
+
+		# the fingerprints of all the types of a category in one list,
+		# which DiscoverJavaScript matches against the responses. As with
+		# the url-less lists, the list is built once
+		self.indexes['all'] = {'js': [fp for fp_type in self.data['js'] for fp in self.data['js'][fp_type]['fps']]}
+
+		# the order in which DiscoverCMS requests the urls
+		self.indexes['probe_order'] = {'cms': get_probe_order(self.indexes['url']['cms'])}
+
+
+	def get_url_index(self, category):
+		return self.indexes['url'][category]
+
+
+	def get_name_index(self, category):
+		return self.indexes['name'][category]
+
+
+	def get_probe_order(self, category):
+		return self.indexes['probe_order'][category]
+
+
+	def get_urlless(self, category, fp_type):
+		return self.indexes['urlless'][category][fp_type]
+
+
+	def get_all(self, category):
+		return self.indexes['all'][category]
+
+
+	def _load_compiled(self):
+		if self.compiled_file is None or not os.path.exists(self.compiled_file):
+			return False
+
+		try:
+			with open(self.compiled_file, 'rb') as fh:
+				with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+					payload = _read_compiled(mm, get_source_signature(self.data))
+		except Exception as e:
+			payload = None
+
+		if payload is None:
+			return False
+
+		self.data = payload['data']
+		self.indexes = payload['indexes']
+		return True
+
+
+def get_identified(url_index):
+	"""
+	Returns the (name, version) pairs each url can identify, and the
+	weight of each pair: url -> set of pairs, and pair -> weight.
+
+	A md5 fingerprint identifies the version it is for. The other
+	fingerprints are assumed to identify every version of their CMS.
+	Every CMS has the same weight, which is shared by its versions,
+	so the weights of the pairs sum to 1.
+	"""
+	versions = defaultdict(set)
+	for fps in url_index.values():
+		for fp in fps:
+			if fp.get('type') == 'md5':
+				versions[fp['name']].add(fp['output'])
+
+	identified = {}
+	for url, fps in url_index.items():
+		pairs = set()
+		for fp in fps:
+			if fp.get('type') == 'md5':
+				pairs.add((fp['name'], fp['output']))
+			else:
+				pairs.update((fp['name'], version) for version in versions[fp['name']] or [None])
+
+		identified[url] = pairs
+
+	names = set(name for pairs in identified.values() for name, version in pairs)
+	weights = {}
+	for name in names:
+		name_versions = versions[name] or [None]
+		for version in name_versions:
+			weights[(name, version)] = 1 / (len(names) * len(name_versions))
+
+	return identified, weights
+
+
+def get_probe_order(url_index):
+	"""
+	Order the urls so the ones most likely to identify the CMS of a
+	site are requested first.
+
+	The gain of a url is the weight of the (name, version) pairs it
+	identifies (see get_identified) that are not identified by the urls
+	before it. The url with the largest gain is picked each time, so a
+	url that identifies many CMSs, or most of the versions of a CMS,
+	comes first, and a url that only identifies what an earlier url
+	already does comes later. The urls that add nothing are last, by
+	the weight of their pairs. Ties keep the order of the index.
+	"""
+	identified, weights = get_identified(url_index)
+	urls = list(url_index)
+	position = {url: i for i, url in enumerate(urls)}
+
+	def get_gain(url, pairs):
+		return sum(weights[pair] for pair in pairs)
+
+	# the gains only decrease, so a gain from the heap that is still the
+	# same after it is recalculated is the largest
+	covered = set()
+	heap = [(-get_gain(url, identified[url]), position[url], url) for url in urls]
+	heapq.heapify(heap)
+
+	order = []
+	while heap:
+		gain, i, url = heapq.heappop(heap)
+		new_gain = get_gain(url, identified[url] - covered)
+		if new_gain < -gain - 1e-12:
+			heapq.heappush(heap, (-new_gain, i, url))
+			continue
+
+		if new_gain <= 0:
+			heapq.heappush(heap, (gain, i, url))
+			break
+
+		order.append(url)
+		covered.update(identified[url])
+
+	rest = sorted((url for gain, i, url in heap), key=lambda url: (-get_gain(url, identified[url]), position[url]))
+	return order + rest
+
+
+def get_source_signature(data):
+	# a signature of all the JSON files the fingerprints are loaded from.
+	# this is used to detect if the compiled fingerprints are stale
+	files = []
+	for name in data:
+		if 'file' in data[name]:
+			files.append(data[name]['file'])
+		elif 'dir' in data[name]:
+			files.extend(os.path.join(data[name]['dir'], f) for f in os.listdir(data[name]['dir']))
+		else:
+			for fp_type in data[name]:
+				fp_dir = data[name][fp_type]['dir']
+				files.extend(os.path.join(fp_dir, f) for f in os.listdir(fp_dir))
+
+	signature = hashlib.sha1()
+	for filename in sorted(files):
+		stat = os.stat(filename)
+		signature.update(('%s:%s:%s\n' % (filename, stat.st_size, stat.st_mtime_ns)).encode('utf-8'))
+
+	return signature.digest()
+
+
+def _read_compiled(buf, source_signature):
+	# returns the payload of a compiled fingerprint database, or None if
+	# the database is invalid, of another version or stale
+	if len(buf) < COMPILED_HEADER.size:
+		return None
+
+	magic, version, length, checksum, signature = COMPILED_HEADER.unpack_from(buf, 0)
+	if not magic == COMPILED_MAGIC or not version == COMPILED_VERSION:
+		return None
+
+	if not signature == source_signature:
+		return None
+
+	with memoryview(buf) as view:
+		with view[COMPILED_HEADER.size:COMPILED_HEADER.size + length] as payload:
+			if not len(payload) == length or not hashlib.sha256(payload).digest() == checksum:
+				return None
+
+			return pickle.loads(payload)
+
+
+class FingerprintCompiler(object):
+	"""
+	Compiles the JSON fingerprints into a single binary file, which
+	is loaded by Fingerprints using mmap.
+
+	The file consists of a header (see COMPILED_HEADER) followed by the
+	pickled fingerprints and their indexes. Identical strings in the
+	fingerprints are shared, which makes the file smaller and faster to
+	load.
+	"""
+
+	def __init__(self, compiled_file=COMPILED_FILE):
+		self.compiled_file = compiled_file
+		self.strings = {}
+
+	def _share_strings(self, obj):
+		if isinstance(obj, str):
+			return self.strings.setdefault(obj, obj)
+		elif isinstance(obj, dict):
+			return {self._share_strings(k): self._share_strings(v) for k, v in obj.items()}
+		elif isinstance(obj, list):
+			return [self._share_strings(i) for i in obj]
+		else:
+			return obj
+
+	def compile(self):
+		fps = Fingerprints(compiled_file=None)
+		fps.data = self._share_strings(fps.data)
+		fps._build_indexes()
+
+		payload = pickle.dumps({'data': fps.data, 'indexes': fps.indexes}, protocol=pickle.HIGHEST_PROTOCOL)
+		header = COMPILED_HEADER.pack(
+			COMPILED_MAGIC,
+			COMPILED_VERSION,
+			len(payload),
+			hashlib.sha256(payload).digest(),
+			get_source_signature(fps.data)
+		)
+
+		# write to a temporary file first, to avoid leaving a partial
+		# file behind for other processes to load
+		tmp_file = self.compiled_file + '.tmp'
+		with open(tmp_file, 'wb') as fh:
+			fh.write(header)
+			fh.write(payload)
+		os.replace(tmp_file, self.compiled_file)
+
+		return self.compiled_file
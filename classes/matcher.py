@@ -1,14 +1,194 @@
 import re
+import time
+from collections import Counter, defaultdict
+
+
+class RegexSet(object):
+	"""
+	A set of compiled regular expressions combined into a single
+	alternation, so one scan of a text tells if any of them match.
+
+	Patterns that cannot be part of an alternation (backreferences,
+	named groups and global inline flags) are not combined, and have to
+	be checked separately.
+	"""
+
+	not_combinable = re.compile(r'\\\d|\(\?P|\(\?[aiLmsux]+\)')
+
+	def __init__(self, patterns):
+		patterns = sorted(set(patterns))
+
+		self.combined = [p for p in patterns if not self.not_combinable.search(p)]
+		self.separate = [p for p in patterns if self.not_combinable.search(p)]
+		self.regex = None
+
+		if self.combined:
+			try:
+				self.regex = re.compile('|'.join('(?:%s)' % (p, ) for p in self.combined))
+			except re.error:
+				self.separate = patterns
+				self.combined = []
+
+	def search(self, text):
+		return self.regex is not None and self.regex.search(text) is not None
+
+
+class FingerprintIndex(object):
+	"""
+	A list of fingerprints indexed for matching against many responses.
+
+	md5 fingerprints are looked up by the checksum of the response.
+
+	The string fingerprints are grouped by pattern, and each unique
+	pattern is searched for once with 'in' (e.g. 105 cms fingerprints
+	have 87 unique patterns). There is no multi-pattern automaton: one
+	in Python, and a combined regex, are both several times slower than
+	'in' for the number of patterns there are (see
+	bench/bench_string_search.py).
+
+	The regex fingerprints are grouped by status code, and the patterns
+	of each group are combined into a RegexSet, so the fingerprints of
+	a group are only checked if the set matches. The remaining
+	fingerprints are checked as usual.
+
+	The fingerprints are kept in the order of the list, so the matches
+	are the same as for the plain list.
+	"""
+
+	def __init__(self, fingerprints, timings=None):
+		self.fingerprints = fingerprints
+		self.size = len(fingerprints)
+		self.timings = timings
+
+		# md5 -> [(position, fp)]
+		self.md5 = defaultdict(list)
+
+		# pattern -> [(position, fp)]
+		self.strings = defaultdict(list)
+
+		# code -> [(position, fp)]
+		self.regexes = defaultdict(list)
+
+		# [(position, fp)] for all other fingerprints
+		self.other = []
+
+		for position, fp in enumerate(fingerprints):
+			# fingerprints without a type never match
+			if 'type' not in fp:
+				continue
+
+			elif fp['type'] == 'md5' and 'header' not in fp:
+				self.md5[fp['match']].append((position, fp))
+
+			elif fp['type'] == 'string' and 'header' not in fp:
+				self.strings[fp['match']].append((position, fp))
+
+			elif fp['type'] == 'regex' and 'header' not in fp:
+				code = 200 if not 'code' in fp else fp['code']
+				self.regexes[code].append((position, fp))
+
+			else:
+				self.other.append((position, fp))
+
+		# code -> (RegexSet, [(position, fp)] that have to be checked separately)
+		self.regex_sets = {}
+		for code, entries in self.regexes.items():
+			regex_set = RegexSet([fp['match'] for position, fp in entries])
+			separate = set(regex_set.separate)
+			self.regex_sets[code] = (regex_set, [(p, fp) for p, fp in entries if fp['match'] in separate])
+
+	def is_for(self, fingerprints):
+		return self.fingerprints is fingerprints and self.size == len(fingerprints)
+
+	def _search_regex_set(self, code, regex_set, text):
+		start = time.perf_counter()
+		found = regex_set.search(text)
+
+		if self.timings is not None:
+			label = '<%s combined patterns for code %s>' % (len(regex_set.combined), code)
+			self.timings[label] += time.perf_counter() - start
+
+		return found
+
+	def get_candidates(self, response, check_page, is_image):
+		# the fingerprints that can match the response
+		hits = list(self.md5.get(response.md5, []))
+
+		# string and regex fingerprints are not matched against images
+		if self.strings and not is_image:
+			body = response.body
+			for pattern, entries in self.strings.items():
+				if pattern in body:
+					hits.extend(entries)
+
+		if self.regexes and not is_image:
+			for code, entries in self.regexes.items():
+				# all the fingerprints in the group have the same code,
+				# so check the page once for the whole group
+				if not check_page(response, entries[0][1]):
+					continue
+
+				regex_set, separate = self.regex_sets[code]
+				if self._search_regex_set(code, regex_set, response.body):
+					hits.extend(entries)
+				else:
+					hits.extend(separate)
+
+		if not hits:
+			return [fp for position, fp in self.other]
+
+		return [fp for position, fp in sorted(hits + self.other, key=lambda x: x[0])]
+
 
 class Match(object):
 	def __init__(self):
-		self.error_pages = set()	
+		self.error_pages = set()
+
+		# indexes of the fingerprint lists. See get_index
+		self.indexes = {}
+
+		# compiled regexes: pattern -> compiled pattern
+		self.regexes = {}
+
+		# the time spent on each regex: pattern -> seconds
+		self.regex_timings = Counter()
+
+
+	def load_regexes(self, fingerprints):
+		# compile the patterns of all the regex fingerprints
+		for category in ['cms', 'js', 'platform']:
+			for fp_type in fingerprints.data[category]:
+				for fp in fingerprints.data[category][fp_type]['fps']:
+					if 'type' in fp and fp['type'] == 'regex':
+						self._compile(fp['match'])
+
+
+	def _compile(self, pattern):
+		regex = self.regexes.get(pattern)
+		if regex is None:
+			regex = re.compile(pattern)
+			self.regexes[pattern] = regex
+
+		return regex
+
+
+	def get_index(self, key, fingerprints):
+		# get the index of a fingerprint list. The index is only rebuilt
+		# if the list has changed since it was last indexed
+		index = self.indexes.get(key)
+		if index is None or not index.is_for(fingerprints):
+			index = FingerprintIndex(fingerprints, self.regex_timings)
+			self.indexes[key] = index
+
+		return index
+
+
+	def get_slowest_regexes(self, num=5):
+		return self.regex_timings.most_common(num)
+
 	
 	def _check_page(self, response, fingerprint):
 
-		# check if the page is a 404
-		is_404 = response.status['code'] == 404 or response.md5_404 in self.error_pages
-
 		# fingerprints that do not have a 'code' set, default to 200
 		# find the 'code' of the current fingerprint
 		fp_code = 200 if not 'code' in fingerprint else fingerprint['code']
@@ -16,8 +196,12 @@ class Match(object):
 		if fp_code == 'any':
 			return True
 
+		# check if the page is a 404
+		# (the error page checksum of the response is only computed here)
+		is_404 = response.status['code'] == 404 or response.md5_404 in self.error_pages
+
 		# if the fingerprint is for a 404 but the page is not a 404, do not match
-		elif (not is_404) and fp_code == 404:
+		if (not is_404) and fp_code == 404:
 			return False
 
 		# if the page is a 404 but the fingerprint is not for a 404, do not match
@@ -48,6 +232,11 @@ class Match(object):
 		else:
 			is_image = True
 
+		# only check the fingerprints that can match, if the
+		# fingerprints have been indexed
+		if isinstance(fingerprints, FingerprintIndex):
+			fingerprints = fingerprints.get_candidates(response, self._check_page, is_image)
+
 		for fingerprint in fingerprints:
 			match = None
 			
@@ -75,8 +264,10 @@ class Match(object):
 				match = None
 
 			if match is not None:
+				# the fingerprints are shared by the scans, so the url
+				# is set on a copy
 				if match['url'] == '':
-					match['url'] = response.get_url()
+					match = dict(match, url=response.get_url())
 
 				matches.append(match)
 
@@ -98,19 +289,31 @@ class Match(object):
 
 	
 	def regex(self, fingerprint, response):
+		regex = self._compile(fingerprint["match"])
+		output = fingerprint["output"]
+
+		start = time.perf_counter()
+		match = regex.search(response.body)
+		self.regex_timings[fingerprint["match"]] += time.perf_counter() - start
+
+		if match is None:
+			return None
+
 		# create copy of fingerprint
 		copy = {key:fingerprint[key] for key in fingerprint}
-		regex = copy["match"]
-		output = copy["output"]
 
-		matches = re.findall(regex, response.body)
-		if len(matches):
-			if "%" in output:
-				copy['output'] = output % matches[0]
-			
-			return copy
-		else:
-			return None
+		# the output uses the same value as re.findall would return
+		# for the first match
+		groups = match.groups('')
+		if "%" in output:
+			if len(groups) == 0:
+				copy['output'] = output % match.group(0)
+			elif len(groups) == 1:
+				copy['output'] = output % groups[0]
+			else:
+				copy['output'] = output % groups
+
+		return copy
 
 	
 	def header(self, fingerprint, response):
@@ -1,4 +1,5 @@
 import os
+import threading
 
 
 class Printer:
@@ -17,6 +18,10 @@ class Printer:
 
 		self.current_line = ''
 
+		# the lines printed by a thread that is buffering them, e.g. for
+		# a stage of the scan (see StageScheduler)
+		self.local = threading.local()
+
 	def _find_color_by_name(self, name):
 		for color in self.verbosity_colors:
 			if color['name'] == name: return color['code']
@@ -42,6 +47,25 @@ class Printer:
 		
 		return '\x1b[%sm%s\x1b[0m' % (';'.join(attr), string)		
 
+	def _print(self, line):
+		buffer = getattr(self.local, 'buffer', None)
+		if buffer is None:
+			print(line)
+		else:
+			buffer.append(line)
+
+	def start_buffer(self):
+		# keep the lines printed by this thread, until stop_buffer
+		self.local.buffer = []
+
+	def stop_buffer(self):
+		lines, self.local.buffer = self.local.buffer, None
+		return lines
+
+	def print_lines(self, lines):
+		for line in lines:
+			self._print(line)
+
 	def build_line(self, text, color='normal', bold=False):
 		color_code = self._find_color_by_name(color)
 		self.current_line += self._format(text, color_code, bold)
@@ -50,7 +74,7 @@ class Printer:
 		try:
 			if self.verbosity >= 0:
 				if not self.current_line == '':
-					print(self.current_line)
+					self._print(self.current_line)
 				self.current_line = ''
 		except Exception as e:
 			self.current_line = ''
@@ -59,7 +83,7 @@ class Printer:
 	def print_debug_line(self, text, verbosity, bold=False):
 		if self.verbosity >= verbosity:
 			color = self._find_color_by_verbosity(verbosity)
-			print(self._format(text, color, bold))
+			self._print(self._format(text, color, bold))
 
 	def print_logo(self):
 		logo = """\nwig - WebApp Information Gatherer\n\n"""
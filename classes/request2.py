@@ -1,10 +1,19 @@
+import codecs
 import concurrent.futures
 import hashlib
+import http.client
+import itertools
+import queue
 import re
 import string
 import random
+import threading
+import time
+import urllib.error
 import urllib.request
 import urllib.parse
+import zlib
+from collections import defaultdict
 from html.parser import HTMLParser
 
 
@@ -20,58 +29,179 @@ class HTMLStripper(HTMLParser):
 		return ''.join(self.tagtext)
 
 
-def _clean_page(page):
-	# this the same method nmap's http.lua uses for error page detection
-	# nselib/http.lua: clean_404
-	# remove information from the page that might not be static
-	
-	# time
-	page = re.sub(b'(\d?\d:?){2,3}', b'',page)
-	page = re.sub(b'AM', b'',page, flags=re.IGNORECASE)
-	page = re.sub(b'PM', b'',page, flags=re.IGNORECASE)
-	page = re.sub(b'(\d){13}', b'', page) # timestamp
-
-	# date with 4 digit year
-	page = re.sub(b'(\d){8}', '',page)
-	page = re.sub(b'\d{4}-\d{2}-\d{2}', b'',page)
-	page = re.sub(b'\d{4}/\d{2}/\d{2}', b'',page)
-	page = re.sub(b'\d{2}-\d{2}-\d{4}', b'',page)
-	page = re.sub(b'\d{2}/\d{2}/\d{4}', b'',page)
-
-	# date with 2 digit year
-	page = re.sub( b'(\d){6}', '',page)
-	page = re.sub( b'\d{2}-\d{2}-\d{2}', b'',page)
-	page = re.sub( b'\d{2}/\d{2}/\d{2}', b'',page)
-	
+# the parts of a page that might not be static, which are removed
+# before the error page checksum is calculated. This is the same method
+# nmap's http.lua uses for error page detection (nselib/http.lua: clean_404)
+_CLEAN_PAGE_REGEX = re.compile(
+	# times, timestamps and dates
+	rb'(?:\d?\d:?){2,3}'
+	# AM/PM
+	rb'|[AaPp][Mm]'
 	# links and paths
-	page = re.sub( b'/[^ ]+',  b'', page)
-	page = re.sub( b'[a-zA-Z]:\\[^ ]+',  b'', page)
+	rb'|/[^ ]+'
+	rb'|[a-zA-Z]:\\[^ ]+'
+)
+
+# the version of the checksums calculated by _clean_page. Cached
+# checksums of other versions are calculated again
+_CLEAN_PAGE_VERSION = 2
+
+
+def _clean_page(page):
+	"""
+	Calculate the error page checksum of a page in a single pass.
+
+	Previous versions removed each pattern from the whole page with a
+	chain of re.sub calls. This single pass gives the same result, with
+	two documented differences:
+	 - an AM or PM that only forms once the digits in it are removed
+	   (e.g. 'a12m' or 'p1:2M') is not removed
+	 - windows paths ('C:\\...') are removed, which the old pattern was
+	   meant to do, but did not due to a missing escape
+
+	The parts between the matches are hashed directly from the page,
+	without creating a cleaned copy of it.
+	"""
+	md5 = hashlib.md5()
+	position = 0
+
+	with memoryview(page) as view:
+		for match in _CLEAN_PAGE_REGEX.finditer(page):
+			md5.update(view[position:match.start()])
+			position = match.end()
+		md5.update(view[position:])
 
 	# return the fingerprint of the stripped page 
-	return hashlib.md5(page).hexdigest().lower()
+	return md5.hexdigest()
+
+
+def _is_binary_content(content_type):
+	# only media types are known not to be text. Some servers send text
+	# files, like changelogs, as 'application/octet-stream'
+	if content_type is None:
+		return False
+
+	content_type = content_type.strip().lower()
+	return content_type.startswith(('image/', 'audio/', 'video/', 'font/'))
+
+
+# the zlib window bits to try for each supported content encoding.
+# Some servers send 'deflate' bodies without the zlib header
+_CONTENT_ENCODINGS = {
+	'gzip': [16 + zlib.MAX_WBITS],
+	'x-gzip': [16 + zlib.MAX_WBITS],
+	'deflate': [zlib.MAX_WBITS, -zlib.MAX_WBITS],
+}
+
+ACCEPT_ENCODING = 'gzip, deflate'
+
+
+class ResponseBody(object):
+	"""
+	Collects the body of a response as it is read in chunks.
+
+	The md5 is calculated over the whole body, but at most 'max_size'
+	bytes of it are kept. Bodies of images and other media are not kept
+	at all, as they are only ever matched by their md5.
+
+	Compressed bodies are decoded as they are read, so the md5 and the
+	kept body are those of the decoded body. 'finish' must be called
+	when the whole body has been added.
+	"""
+
+	chunk_size = 64 * 1024
+
+	def __init__(self, content_type, max_size, content_encoding=None):
+		self.md5 = hashlib.md5()
+		self.max_size = max_size
+		self.keep = not _is_binary_content(content_type)
 
+		self.chunks = []
+		self.size = 0
+		self.kept_size = 0
+		self.truncated = False
 
-def _create_response(response):
+		encoding = (content_encoding or '').strip().lower()
+		self.wbits = _CONTENT_ENCODINGS.get(encoding, [])
+		self.decompressor = None
+
+	def _start_decoding(self, chunk):
+		# the first chunk shows how the body is compressed, if at all
+		for wbits in self.wbits:
+			decompressor = zlib.decompressobj(wbits)
+			try:
+				data = decompressor.decompress(chunk, self.chunk_size)
+			except zlib.error:
+				continue
+
+			self.decompressor = decompressor
+			return data
+
+		self.wbits = []
+		return chunk
+
+	def add(self, chunk):
+		if self.decompressor is not None:
+			self._add_decoded(self.decompressor.decompress(chunk, self.chunk_size))
+		elif self.wbits:
+			self._add_decoded(self._start_decoding(chunk))
+		else:
+			self._add_decoded(chunk)
+
+		# decode the chunk in parts, so a small chunk cannot fill the memory
+		while self.decompressor is not None and self.decompressor.unconsumed_tail:
+			self._add_decoded(self.decompressor.decompress(self.decompressor.unconsumed_tail, self.chunk_size))
+
+	def finish(self):
+		if self.decompressor is not None:
+			self._add_decoded(self.decompressor.flush())
+			self.decompressor = None
+		self.wbits = []
+
+	def _add_decoded(self, chunk):
+		self.md5.update(chunk)
+		self.size += len(chunk)
+
+		if not self.keep or self.truncated:
+			return
+
+		if self.kept_size + len(chunk) > self.max_size:
+			chunk = chunk[:self.max_size - self.kept_size]
+			self.truncated = True
+
+		self.chunks.append(chunk)
+		self.kept_size += len(chunk)
+
+	def get_body(self):
+		return b''.join(self.chunks) if self.keep else None
+
+
+def _create_response(response, max_size):
+	body = ResponseBody(response.getheader('content-type'), max_size, response.getheader('content-encoding'))
+	while True:
+		chunk = response.read(ResponseBody.chunk_size)
+		if not chunk:
+			break
+		body.add(chunk)
+
+	return _build_response(response.geturl(), response.code, response.reason, response.getheaders(), body)
+
+
+def _build_response(url, code, reason, headers, body):
 	R = Response()
 
-	url = response.geturl()
 	response_info = urllib.request.urlparse(url)
-	body = response.read()
-
-	# get the page text only
-	parser = HTMLStripper()
-	parser.feed(body.decode('utf-8', 'ignore'))
-	page_text = parser.get_tagtext()
 
-	R.set_body(body)
+	body.finish()
+	R.set_body(body.get_body())
+	R.body_size = body.size
+	R.body_truncated = body.truncated
 	R.protocol = response_info.scheme
 	R.host = response_info.netloc
 	R.url = url
-	R.status = {'code': response.code, 'text': response.reason}
-	R.headers = {pair[0].lower():pair[1] for pair in response.getheaders()}
-	R.md5 = hashlib.md5(body).hexdigest().lower()
-	R.md5_404 = _clean_page(body)
-	R.md5_404_text = _clean_page(page_text.encode('utf-8', 'ignore'))
+	R.status = {'code': code, 'text': reason}
+	R.headers = {pair[0].lower():pair[1] for pair in headers}
+	R.md5 = body.md5.hexdigest().lower()
 
 	return(R)
 
@@ -131,6 +261,172 @@ class RedirectHandler(urllib.request.HTTPRedirectHandler):
 	http_error_301 = http_error_303 = http_error_307 = http_error_302
 
 
+#######################################################################
+#
+# Keep-alive connections
+#
+#######################################################################
+
+class PooledHTTPResponse(http.client.HTTPResponse):
+	"""
+	A response that hands its connection back to the pool once the
+	body has been read. The connection is discarded if the response
+	is closed before the whole body has been read.
+	"""
+
+	release = None
+
+	def _close_conn(self):
+		super()._close_conn()
+		self._release(True)
+
+	def close(self):
+		if self.fp:
+			self._release(False)
+		super().close()
+
+	def _release(self, reusable):
+		release, self.release = self.release, None
+		if release is not None:
+			release(reusable)
+
+
+class PooledHTTPConnection(http.client.HTTPConnection):
+	response_class = PooledHTTPResponse
+
+
+class PooledHTTPSConnection(http.client.HTTPSConnection):
+	response_class = PooledHTTPResponse
+
+
+class ConnectionPool(object):
+	"""
+	Keep-alive connections shared by all the threads of a Requester.
+
+	Idle connections are kept per (scheme, host, port). At most
+	'max_size' idle connections are kept for each of them, and
+	connections that have been idle for more than 'idle_timeout'
+	seconds are closed.
+	"""
+
+	def __init__(self, max_size=10, idle_timeout=15):
+		self.max_size = max_size
+		self.idle_timeout = idle_timeout
+		self.lock = threading.Lock()
+
+		# key -> [(connection, time of last use)]
+		self.idle = defaultdict(list)
+
+	def _get(self, key):
+		now = time.time()
+		with self.lock:
+			connections = self.idle[key]
+			while connections:
+				connection, last_used = connections.pop()
+				if now - last_used < self.idle_timeout:
+					return connection
+				connection.close()
+
+		return None
+
+	def _put(self, key, connection):
+		with self.lock:
+			connections = self.idle[key]
+			if connection.sock is not None and len(connections) < self.max_size:
+				connections.append((connection, time.time()))
+				return
+
+		connection.close()
+
+	def open(self, connection_class, req, **kwargs):
+		# this mirrors urllib.request.AbstractHTTPHandler.do_open, but
+		# reuses the connections instead of closing them
+		host = req.host
+		if not host:
+			raise urllib.error.URLError('no host given')
+
+		key = (req.type, host, req._tunnel_host)
+
+		headers = dict(req.unredirected_hdrs)
+		headers.update({k: v for k, v in req.headers.items() if k not in headers})
+		headers['Connection'] = 'keep-alive'
+		headers = {name.title(): val for name, val in headers.items()}
+
+		tunnel_headers = {}
+		if req._tunnel_host:
+			proxy_auth_hdr = 'Proxy-Authorization'
+			if proxy_auth_hdr in headers:
+				tunnel_headers[proxy_auth_hdr] = headers[proxy_auth_hdr]
+				del headers[proxy_auth_hdr]
+
+		# a pooled connection might have been closed by the server
+		# in the meantime. If so, retry once with a new connection
+		connection = self._get(key)
+		while True:
+			is_reused = connection is not None
+			if not is_reused:
+				connection = connection_class(host, timeout=req.timeout, **kwargs)
+				if req._tunnel_host:
+					connection.set_tunnel(req._tunnel_host, headers=tunnel_headers)
+
+			try:
+				connection.request(req.get_method(), req.selector, req.data, headers,
+					encode_chunked=req.has_header('Transfer-encoding'))
+				response = connection.getresponse()
+			except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as err:
+				connection.close()
+				if not is_reused:
+					raise urllib.error.URLError(err)
+				connection = None
+				continue
+			except OSError as err:
+				connection.close()
+				raise urllib.error.URLError(err)
+
+			break
+
+		def release(reusable, connection=connection):
+			if reusable and not response.will_close:
+				self._put(key, connection)
+			else:
+				connection.close()
+
+		response.release = release
+		response.url = req.get_full_url()
+		response.msg = response.reason
+
+		# the response might not have a body (HEAD, 304, etc)
+		if response.isclosed():
+			response._release(True)
+
+		return response
+
+	def close(self):
+		with self.lock:
+			for key in self.idle:
+				for connection, last_used in self.idle[key]:
+					connection.close()
+			self.idle.clear()
+
+
+class KeepAliveHTTPHandler(urllib.request.HTTPHandler):
+	def __init__(self, pool):
+		super().__init__()
+		self.pool = pool
+
+	def http_open(self, req):
+		return self.pool.open(PooledHTTPConnection, req)
+
+
+class KeepAliveHTTPSHandler(urllib.request.HTTPSHandler):
+	def __init__(self, pool):
+		super().__init__()
+		self.pool = pool
+
+	def https_open(self, req):
+		return self.pool.open(PooledHTTPSConnection, req, context=self._context)
+
+
 #######################################################################
 #
 # Custom request and response classes
@@ -143,6 +439,19 @@ class Response:
 
 	The normal http.client.HTTPResponse cannot be pickled
 	which is used in the caching process
+
+	The body is stored as the raw bytes of the response. The decoded
+	body, the stripped text of the page and the error page checksums
+	('md5_404' and 'md5_404_text') are computed the first time they are
+	used, as most responses are only ever matched by their md5.
+
+	The raw body is None if it was not kept (see ResponseBody). The
+	body is then empty and the error page checksums are None.
+
+	The Cache can move the body out of memory with 'unload_body'. It is
+	then loaded again, with the given loader, when it is used. The
+	decoded body of a response in the Cache is kept by the Cache (see
+	'share_body'), once for all the responses with the same body.
 	"""
 
 	def __init__(self):
@@ -151,17 +460,150 @@ class Response:
 		self.host = ''
 		self.status = {}
 		self.headers = {}
-		self.body = ''
 
 		self.md5 = None
-		self.md5_404 = None
 		self.should_be_error_page = False
 
+		# the method of the request
+		self.method = 'GET'
+
+		# the size of the whole body, and if only a part of it was kept
+		self.body_size = 0
+		self.body_truncated = False
+
 		self.crawled_response = False
 
 		chars = string.ascii_uppercase + string.digits
 		self.id = ''.join(random.choice(chars) for _ in range(16))
 
+		self._raw_body = b''
+		self._encoding = 'utf-8'
+		self._body = None
+		self._md5_404 = None
+		self._md5_404_text = None
+		self._clean_page_version = _CLEAN_PAGE_VERSION
+		self._body_loader = None
+		self._body_store = None
+
+
+	def __getstate__(self):
+		# the decoded body is not pickled, as it can be decoded again
+		state = self.__dict__.copy()
+		state['_body'] = None
+		state['_body_loader'] = None
+		state['_body_store'] = None
+		return state
+
+
+	def __setstate__(self, state):
+		# responses pickled by older versions of wig store the decoded
+		# body and the checksums as attributes
+		if '_raw_body' not in state:
+			state['_raw_body'] = None
+			state['_encoding'] = 'utf-8'
+			state['_body'] = state.pop('body', '')
+			state['_md5_404'] = state.pop('md5_404', None)
+			state['_md5_404_text'] = state.pop('md5_404_text', None)
+
+		# the error page checksums are calculated again, if they were
+		# calculated by another version of _clean_page
+		elif not state.get('_clean_page_version') == _CLEAN_PAGE_VERSION:
+			state['_md5_404'] = None
+			state['_md5_404_text'] = None
+			state['_clean_page_version'] = _CLEAN_PAGE_VERSION
+
+		state.setdefault('body_size', 0)
+		state.setdefault('body_truncated', False)
+		state.setdefault('_body_loader', None)
+		state.setdefault('_body_store', None)
+		state.setdefault('method', 'GET')
+
+		self.__dict__.update(state)
+
+
+	@property
+	def body(self):
+		if self._body is None and self._body_store is not None:
+			return self._body_store.get_text(self.md5, self._encoding, self.decode_body)
+
+		if self._body is None:
+			self._body = self.decode_body()
+		return self._body
+
+	@body.setter
+	def body(self, body):
+		self._body = body
+
+
+	@property
+	def raw_body(self):
+		# the loader sets the raw body of the responses that share it.
+		# Another thread can unload it again right away, so the loaded
+		# body is returned instead of the attribute
+		raw_body = self._raw_body
+		if raw_body is None and self._body_loader is not None:
+			raw_body = self._body_loader(self.md5)
+		return raw_body
+
+	@raw_body.setter
+	def raw_body(self, raw_body):
+		# the raw body is only replaced by an equal one (see Cache), so
+		# the decoded body and the checksums are still valid
+		self._raw_body = raw_body
+
+
+	def decode_body(self):
+		raw_body = self.raw_body
+		return '' if raw_body is None else str(raw_body, self._encoding, errors='replace')
+
+
+	def share_body(self, store):
+		# the decoded body is kept by 'store' instead of the response, so
+		# it is shared by the responses with the same body
+		self._body = None
+		self._body_store = store
+
+
+	def is_body_unloaded(self):
+		return self._raw_body is None and self._body_loader is not None
+
+
+	def unload_body(self, loader):
+		# free the memory used by the body. It is loaded again with
+		# 'loader', which is called with the md5 of the body
+		self._raw_body = None
+		self._body = None
+		self._body_loader = loader
+
+
+	@property
+	def md5_404(self):
+		if self._md5_404 is None and self.raw_body is not None:
+			self._md5_404 = _clean_page(self.raw_body)
+		return self._md5_404
+
+	@md5_404.setter
+	def md5_404(self, md5_404):
+		self._md5_404 = md5_404
+
+
+	@property
+	def md5_404_text(self):
+		if self._md5_404_text is None and self.raw_body is not None:
+			self._md5_404_text = _clean_page(self.get_page_text().encode('utf-8', 'ignore'))
+		return self._md5_404_text
+
+	@md5_404_text.setter
+	def md5_404_text(self, md5_404_text):
+		self._md5_404_text = md5_404_text
+
+
+	def get_page_text(self):
+		# get the page text only
+		parser = HTMLStripper()
+		parser.feed(self.raw_body.decode('utf-8', 'ignore'))
+		return parser.get_tagtext()
+
 
 	def get_url(self):
 		url_data =  urllib.request.urlparse(self.url)
@@ -177,7 +619,7 @@ class Response:
 		content_type = 'Content-Type'.lower()
 
 		if content_type not in self.headers:
-			self.body = str(body, errors='replace')
+			encoding = 'utf-8'
 
 		else:
 			# find content-type definitions
@@ -192,11 +634,20 @@ class Response:
 
 			# set the encoding to use
 			if content_types['charset'] is not None:
-				self.body = str(body, content_types['charset'], errors='replace')
+				encoding = content_types['charset']
 			elif content_types['text']:
-				self.body = str(body, 'ISO-8859-1', errors='replace')
+				encoding = 'ISO-8859-1'
 			else:
-				self.body = str(body, errors='replace')
+				encoding = 'utf-8'
+
+		# fail on unknown encodings here, as decoding the body would
+		codecs.lookup(encoding)
+
+		self._raw_body = body
+		self._encoding = encoding
+		self._body = None
+		self._md5_404 = None
+		self._md5_404_text = None
 		
 
 	def __repr__(self):
@@ -205,8 +656,8 @@ class Response:
 			string += '%s %s\n' %(r.status['code'], r.status['text'])
 			string += '\n'.join([header +': '+ r.headers[header] for header in r.headers])
 			string += '\n\n'
-			string += 'MD5:            ' + self.md5 + '\n'
-			string += 'MD5 Error page: ' + self.md5_404 + '\n'
+			string += 'MD5:            %s\n' % (self.md5, )
+			string += 'MD5 Error page: %s\n' % (self.md5_404, )
 			return string 
 
 		return get_string(self)
@@ -217,10 +668,10 @@ class Requester:
 		self.threads = options['threads']
 		self.proxy = options['proxy']
 		self.user_agent = options['user_agent']
+		self.max_body_size = options['max_body_size']
 
 		self.data = data
 		self.cache = data['cache']
-		self.requested = data['requested']
 		self.printer = data['printer']
 
 		self.is_redirected = False
@@ -232,8 +683,22 @@ class Requester:
 			self.url_data.path = options['prefix'] + self.url_data.path
 		self.url = urllib.request.urlunparse(self.url_data)
 
+		# keep-alive connections shared by all the threads
+		self.pool = ConnectionPool(max_size=self.threads)
+
+		# the threads are shared by all the runs, so stages running at
+		# the same time do not make more requests at once
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+
+		# the number of requests a stream keeps in flight
+		self.window = self.threads
+
+	def close(self):
+		self.executor.shutdown()
+		self.pool.close()
+
 	def _create_fetcher(self, redirect_handler=True):
-		args = [ErrorHandler]
+		args = [ErrorHandler, KeepAliveHTTPHandler(self.pool), KeepAliveHTTPSHandler(self.pool)]
 		if self.proxy == None:
 			args.append(urllib.request.ProxyHandler({}))
 		elif not self.proxy == False:
@@ -244,7 +709,7 @@ class Requester:
 			args.append(RedirectHandler)
 		
 		opener = urllib.request.build_opener(*args)
-		opener.addheaders = [('User-agent', self.user_agent)]
+		opener.addheaders = [('User-agent', self.user_agent), ('Accept-Encoding', ACCEPT_ENCODING)]
 		return opener
 
 	def detect_redirect(self):
@@ -275,37 +740,37 @@ class Requester:
 			self.printer.print_debug_line('%s does not redirect' % (org_loc, ), 2)
 
 		# create an response object and add it to the cache
-		R = _create_response(response)
+		R = _create_response(response, self.max_body_size)
 		self.cache[new_loc] = R
 		self.cache[self.url] = R
 
 		return (self.is_redirected, new_loc)
 
-	def do_request(self, url, run_type=None, method='GET'):
+	def do_request(self, url, run_type=None, method='GET', stale=None):
 		opener = self._create_fetcher()
-		request = urllib.request.Request(url, method=method)
+		request = urllib.request.Request(url, method=method, headers=self._get_validators(stale))
 		response = opener.open(request)
-		R = _create_response(response)
-		
-		if run_type == 'DiscoverMore':
-			R.crawled_response = True	
-
-		self.cache[url] = R
-		self.cache[response.geturl()] = R
 
-		return response
+		# the stale response is still valid
+		if stale is not None and response.code == 304:
+			R = stale
+		else:
+			R = _create_response(response, self.max_body_size)
+			R.method = method
 
+		self._store_response(R, url, response.geturl(), run_type)
 
-	def request(self, fp_list, run_type):
-		url = fp_list[0]['url']
-		complete_url = urllib.parse.urljoin(self.url, url)
+		return response
 
-		R = None
 
-		# check if the url is out of scope
+	def _is_in_scope(self, complete_url):
 		url_data = urllib.parse.urlparse(complete_url)
 		host_data = urllib.parse.urlparse(self.url)
-		
+
+		return url_data.netloc == host_data.netloc
+
+
+	def _can_use_head(self, fp_list):
 		# check if it is possible to use 'HEAD' instead of 'GET'
 		# this should be possible for all fingerprints, that do not
 		# have a specified a 'code' or 'code' is '200'.
@@ -316,27 +781,95 @@ class Requester:
 			if 'code' in fp and (fp['code'] == 'any' or fp['code'] != 200):
 				can_use_head = False
 
-		if not url_data.netloc == host_data.netloc:
+		return can_use_head
+
+
+	def _is_known_missing(self, complete_url, can_use_head):
+		# check if the url was found missing, in this scan or in an
+		# earlier one. If the fingerprints need the response whatever
+		# its status, only a failed request is not tried again
+		status = self.cache.get_missing(complete_url)
+		if status is None:
+			return False
+
+		return can_use_head or status == 0
+
+
+	def _get_stale(self, complete_url):
+		# get the stale response for the url from the cache, if it can be
+		# revalidated with a conditional request
+		stale = self.cache.get_stale(complete_url)
+		if stale is None or not stale.method == 'GET' or not self._get_validators(stale):
+			return None
+
+		return stale
+
+
+	def _get_validators(self, stale):
+		# the headers of a conditional request for a stale response
+		headers = {}
+		if stale is not None:
+			if 'etag' in stale.headers:
+				headers['If-None-Match'] = stale.headers['etag']
+			if 'last-modified' in stale.headers:
+				headers['If-Modified-Since'] = stale.headers['last-modified']
+
+		return headers
+
+
+	def _store_response(self, R, url, final_url, run_type):
+		# a 'HEAD' is not stored, as another thread or wig process would
+		# take it for the full response. If it returns a '200', it is
+		# followed by a 'GET', otherwise the path is recorded as missing
+		if R.method == 'HEAD':
+			return
+
+		if run_type == 'DiscoverMore':
+			R.crawled_response = True	
+
+		self.cache[url] = R
+		self.cache[final_url] = R
+
+
+	def request(self, fp_list, run_type):
+		url = fp_list[0]['url']
+		complete_url = urllib.parse.urljoin(self.url, url)
+
+		R = None
+
+		can_use_head = self._can_use_head(fp_list)
+
+		# check if the url is out of scope
+		if not self._is_in_scope(complete_url):
 			pass
 
 		elif not complete_url in self.cache:
+			# a path found missing by an earlier request is not probed again
+			if self._is_known_missing(complete_url, can_use_head):
+				return (fp_list, R)
+
+			# a stale response from an earlier scan is revalidated with
+			# a conditional 'GET' instead
+			stale = self._get_stale(complete_url)
+
 			try:
 				# if it is possible to use 'HEAD', use it. If the result is 
 				# a '200', request the resource with a 'GET'
 				get_resource = True
-				if can_use_head:
+				if can_use_head and stale is None:
 					response = self.do_request(complete_url, run_type, method='HEAD')
 					if not response.code == 200:
 						get_resource = False
+						self.cache.add_missing(complete_url, response.code)
 
 				# Fetch the ressource if the resource exists or 
 				# if the fingerprint requires any response
 				if get_resource:
-					self.do_request(complete_url, run_type, method='GET')
+					self.do_request(complete_url, run_type, method='GET', stale=stale)
 					R = self.cache[complete_url]
 			
 			except Exception as e:
-				pass
+				self.cache.add_missing(complete_url, 0)
 		else:
 			R = self.cache[complete_url]
 
@@ -344,13 +877,65 @@ class Requester:
 
 
 	def run(self, run_type=None, fp_lists=[]):
-		with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
-			future_list = []
+		# every run has its own queue of results, as several stages can
+		# run at the same time
+		requested = queue.Queue()
 
-			for fp_list in fp_lists:
-				future_list.append(executor.submit(self.request, fp_list, run_type))
-				
-			for future in concurrent.futures.as_completed(future_list):
-				self.requested.put(future.result())
+		future_list = []
+		for fp_list in fp_lists:
+			future_list.append(self.executor.submit(self.request, fp_list, run_type))
 
-		return self.requested
\ No newline at end of file
+		for future in concurrent.futures.as_completed(future_list):
+			requested.put(future.result())
+
+		return requested
+
+
+	def _submit(self, fp_list, run_type):
+		# start a request, returns a concurrent.futures.Future
+		return self.executor.submit(self.request, fp_list, run_type)
+
+
+	def stream(self, run_type, fp_lists, window=None, cancel=None):
+		"""
+		Request the urls of the fingerprint lists, and yield the
+		(fp_list, Response) tuples as the requests complete.
+
+		Unlike 'run', the requests are not sent in batches: at most
+		'window' requests are in flight, and a new one is sent as soon
+		as one completes. 'fp_lists' is only read when a request is
+		sent, so it can be a generator over a queue that changes.
+
+		After each response, the outstanding requests of the
+		fingerprint lists for which 'cancel(fp_list)' is true are
+		cancelled, if they have not started yet. Closing the generator
+		cancels all the requests that are still outstanding, e.g. once
+		the caller has found what it was looking for.
+		"""
+		window = window or self.window
+		fp_lists = iter(fp_lists)
+
+		# future -> the fingerprint list it requests
+		pending = {}
+
+		try:
+			while True:
+				for fp_list in itertools.islice(fp_lists, window - len(pending)):
+					pending[self._submit(fp_list, run_type)] = fp_list
+
+				if not pending:
+					break
+
+				done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+				for future in done:
+					del pending[future]
+					yield future.result()
+
+				if cancel is not None:
+					for future, fp_list in list(pending.items()):
+						if cancel(fp_list) and future.cancel():
+							del pending[future]
+
+		finally:
+			for future in pending:
+				future.cancel()
\ No newline at end of file
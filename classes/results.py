@@ -1,3 +1,4 @@
+import threading
 from collections import defaultdict, Counter
 
 from classes.sitemap import Sitemap
@@ -26,6 +27,10 @@ class Results(object):
 
 		self.sitemap = Sitemap()
 
+		# the stages of a scan can run at the same time, so the
+		# results are only changed and read while holding the lock
+		self.lock = threading.RLock()
+
 		self.site_info = {
 			'ip': '',
 			'title': '',
@@ -49,6 +54,11 @@ class Results(object):
 
 
 	def add(self, category, name, version=None, fingerprint=None, weight=1):
+		with self.lock:
+			self._add(category, name, version, fingerprint, weight)
+
+
+	def _add(self, category, name, version, fingerprint, weight):
 		url = ''
 		match_type = ''
 
@@ -98,6 +108,11 @@ class Results(object):
 
 
 	def update(self):
+		with self.lock:
+			self._update()
+
+
+	def _update(self):
 		self._calc_md5_score()
 		for category in self.scores:
 
@@ -122,33 +137,37 @@ class Results(object):
 
 
 	def add_vulnerabilities(self, cms, version, num_vuln, link):
-		if 'vulnerability' not in self.results: self.results['vulnerability'] = {}
-		self.results['vulnerability'][(cms,version)] = {'col2': num_vuln, 'col3': link}
+		with self.lock:
+			if 'vulnerability' not in self.results: self.results['vulnerability'] = {}
+			self.results['vulnerability'][(cms,version)] = {'col2': num_vuln, 'col3': link}
 
 
 	def add_tool(self, cms, tool_name, tool_link):
-		if 'tool' not in self.results:
-			self.results['tool'] = {}
+		with self.lock:
+			if 'tool' not in self.results:
+				self.results['tool'] = {}
 
-		self.results['tool'][tool_name] = {'col2': cms, 'col3': tool_link}
+			self.results['tool'][tool_name] = {'col2': cms, 'col3': tool_link}
 
 
 	def add_subdomain(self, subdomain, title, ip):
-		if 'subdomains' not in self.results:
-			self.results['subdomains'] = {}
+		with self.lock:
+			if 'subdomains' not in self.results:
+				self.results['subdomains'] = {}
 
-		self.results['subdomains'][subdomain] = {'col2': title, 'col3': ip}
+			self.results['subdomains'][subdomain] = {'col2': title, 'col3': ip}
 
 
 	def get_versions(self):
-		versions = []
-		for cat in ['cms', 'javascript', 'os', 'platform']:
-			if cat not in self.results: continue
-			for cms in self.results[cat]:
-				for version in self.results[cat][cms]:
-					versions.append( (cms, version) )
-
-		return versions
+		with self.lock:
+			versions = []
+			for cat in ['cms', 'javascript', 'os', 'platform']:
+				if cat not in self.results: continue
+				for cms in self.results[cat]:
+					for version in self.results[cat][cms]:
+						versions.append( (cms, version) )
+
+			return versions
 
 
 	def get_sitemap(self):
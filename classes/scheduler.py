@@ -0,0 +1,116 @@
+import concurrent.futures
+import time
+from collections import OrderedDict
+
+
+class StageScheduler(object):
+	"""
+	Runs the stages of a scan as a dependency graph.
+
+	A stage is started as soon as all the stages it depends on have
+	finished, so stages that do not depend on each other run at the
+	same time. The stages that make requests share the threads of the
+	requester, so running them at the same time does not make more
+	requests at once. The time of a scan is that of the longest chain
+	of dependent stages, instead of the sum of all the stages.
+
+	The stages a stage depends on must have been added before it, so
+	the graph cannot have cycles.
+
+	If a stage fails, no more stages are started, and the error is
+	raised by 'run' once the running stages have finished.
+
+	If a printer is given, the lines a stage prints are kept until it
+	has finished, and the lines of the stages are printed in the order
+	the stages were added, so the output is the same as if the stages
+	had run one after the other. Lines printed by other threads for a
+	stage, e.g. by the requester, are printed at once.
+	"""
+
+	def __init__(self, printer=None):
+		# name -> (function, names of the stages it depends on)
+		self.stages = OrderedDict()
+
+		# name -> seconds the stage took
+		self.timings = OrderedDict()
+
+		self.printer = printer
+
+		# name -> the lines printed by the stage, until they are printed
+		self.output = {}
+
+
+	def add(self, name, function, depends=()):
+		if name in self.stages:
+			raise ValueError('Stage already added: %s' % (name, ))
+
+		for dependency in depends:
+			if dependency not in self.stages:
+				raise ValueError('Unknown stage: %s' % (dependency, ))
+
+		self.stages[name] = (function, tuple(depends))
+
+
+	def _run_stage(self, name):
+		start = time.time()
+		if self.printer is not None:
+			self.printer.start_buffer()
+
+		try:
+			self.stages[name][0]()
+		finally:
+			self.timings[name] = time.time() - start
+			if self.printer is not None:
+				self.output[name] = self.printer.stop_buffer()
+
+
+	def _print_output(self, unprinted, is_done=False):
+		# print the lines of the finished stages, in the order the stages
+		# were added. Once all the stages are done, the stages that were
+		# not run are skipped
+		while unprinted and (is_done or unprinted[0] in self.output):
+			lines = self.output.pop(unprinted.pop(0), [])
+			if self.printer is not None:
+				self.printer.print_lines(lines)
+
+
+	def _get_ready(self, waiting, finished):
+		return [name for name in waiting if all(dependency in finished for dependency in self.stages[name][1])]
+
+
+	def run(self):
+		waiting = list(self.stages)
+		unprinted = list(self.stages)
+		finished = set()
+		error = None
+
+		# future -> name of the stage
+		running = {}
+
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.stages), 1)) as executor:
+			while True:
+				if error is None:
+					for name in self._get_ready(waiting, finished):
+						waiting.remove(name)
+						running[executor.submit(self._run_stage, name)] = name
+
+				if not running:
+					break
+
+				done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+				for future in done:
+					name = running.pop(future)
+					if future.exception() is None:
+						finished.add(name)
+					elif error is None:
+						error = future.exception()
+
+				self._print_output(unprinted)
+
+		self._print_output(unprinted, is_done=True)
+		if error is not None:
+			raise error
+
+
+	def get_timings(self):
+		return list(self.timings.items())
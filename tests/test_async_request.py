@@ -0,0 +1,279 @@
+"""
+Tests of the asyncio request engine against stand-in servers.
+
+The same fingerprint lists are requested with the Requester (threads)
+and the AsyncRequester (asyncio), and the (fp_list, Response) results
+of both are compared. The stand-in server sends chunked and gzip
+encoded bodies, redirects within and out of the scope of the host,
+and closes some keep-alive connections after a response. The https
+stand-in is reached through a CONNECT proxy.
+
+Run from the root of the repository:
+
+	python3 -m unittest discover tests
+"""
+
+import gzip
+import http.server
+import os
+import select
+import shutil
+import socket
+import socketserver
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from classes.async_request import AsyncRequester
+from classes.cache import Cache
+from classes.printer import Printer
+from classes.request2 import Requester
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	# the number of connections opened to the server
+	connections = 0
+
+	def setup(self):
+		StandInHandler.connections += 1
+		super().setup()
+
+	def log_message(self, *args):
+		pass
+
+	def _send(self, code, body=b'', headers=()):
+		self.send_response(code)
+		for name, value in headers:
+			self.send_header(name, value)
+		if not any(name == 'Transfer-Encoding' for name, value in headers):
+			self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		if not self.command == 'HEAD':
+			self.wfile.write(body)
+
+	def do_HEAD(self):
+		self.do_GET()
+
+	def do_GET(self):
+		html = [('Content-Type', 'text/html; charset=utf-8')]
+
+		if self.path == '/':
+			self._send(200, b'<html><title>index</title></html>', html)
+
+		elif self.path == '/chunked':
+			self.send_response(200)
+			self.send_header('Content-Type', 'text/html')
+			self.send_header('Transfer-Encoding', 'chunked')
+			self.end_headers()
+			if not self.command == 'HEAD':
+				for chunk in [b'<html>', b'chunked ' * 1000, b'</html>']:
+					self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+				self.wfile.write(b'0\r\n\r\n')
+
+		elif self.path == '/gzip':
+			self._send(200, gzip.compress(b'<html>gzip</html>'), html + [('Content-Encoding', 'gzip')])
+
+		elif self.path == '/redirect':
+			self._send(302, b'', [('Location', '/target')])
+
+		elif self.path == '/target':
+			self._send(200, b'<html>target</html>', html)
+
+		elif self.path == '/offsite':
+			self._send(302, b'', [('Location', 'http://out-of-scope.invalid/')])
+
+		elif self.path == '/close':
+			# the connection is closed without telling the client, as
+			# a server does once its keep-alive timeout has passed
+			self._send(200, b'<html>close</html>', html)
+			self.close_connection = True
+
+		else:
+			self._send(404, b'<html>not found</html>', html)
+
+
+class StandInServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+	daemon_threads = True
+
+
+class TunnelHandler(socketserver.BaseRequestHandler):
+	# a proxy that only supports CONNECT
+
+	# the number of tunnels opened through the proxy
+	tunnels = 0
+
+	def handle(self):
+		head = b''
+		while not head.endswith(b'\r\n\r\n'):
+			data = self.request.recv(1)
+			if not data:
+				return
+			head += data
+
+		method, target = head.split(b' ')[:2]
+		if not method == b'CONNECT':
+			self.request.sendall(b'HTTP/1.1 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n')
+			return
+
+		host, port = target.decode('ascii').rsplit(':', 1)
+		upstream = socket.create_connection((host, int(port)))
+		TunnelHandler.tunnels += 1
+		self.request.sendall(b'HTTP/1.1 200 Connection established\r\n\r\n')
+
+		sockets = [self.request, upstream]
+		try:
+			while True:
+				readable, _, _ = select.select(sockets, [], [], 10)
+				if not readable:
+					return
+				for sock in readable:
+					data = sock.recv(65536)
+					if not data:
+						return
+					(upstream if sock is self.request else self.request).sendall(data)
+		finally:
+			upstream.close()
+
+
+class TunnelServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+	daemon_threads = True
+
+
+def start(server):
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+
+def get_requester(engine, url, proxy=None):
+	options = {
+		'url': url,
+		'prefix': '',
+		'proxy': proxy,
+		'threads': 4,
+		'concurrency': 4,
+		'user_agent': 'wig-test',
+		'max_body_size': 1024 * 1024,
+	}
+	data = {'cache': Cache(), 'printer': Printer(0)}
+
+	return engine(options, data)
+
+
+def get_results(requester, paths, sequential=False):
+	# path -> (code, url, md5, body) of the response, or None. With
+	# 'sequential', the paths are requested one at a time
+	fp_lists = [[{'url': path, 'code': 'any'}] for path in paths]
+	batches = [[fp_list] for fp_list in fp_lists] if sequential else [fp_lists]
+
+	results = {}
+	try:
+		for batch in batches:
+			requested = requester.run('test', batch)
+			while requested.qsize() > 0:
+				fp_list, response = requested.get()
+				results[fp_list[0]['url']] = None if response is None else (
+					response.status['code'], response.get_url(), response.md5, response.body)
+	finally:
+		requester.close()
+
+	return results
+
+
+class TestAsyncRequester(unittest.TestCase):
+
+	paths = ['/', '/chunked', '/gzip', '/redirect', '/offsite', '/missing']
+
+	@classmethod
+	def setUpClass(cls):
+		cls.server = start(StandInServer(('127.0.0.1', 0), StandInHandler))
+		cls.url = 'http://127.0.0.1:%s/' % (cls.server.server_address[1], )
+
+	@classmethod
+	def tearDownClass(cls):
+		cls.server.shutdown()
+		cls.server.server_close()
+
+	def test_same_results_as_threads(self):
+		expected = get_results(get_requester(Requester, self.url), self.paths)
+		results = get_results(get_requester(AsyncRequester, self.url), self.paths)
+
+		self.assertEqual(results, expected)
+		self.assertEqual(results['/chunked'][3], '<html>' + 'chunked ' * 1000 + '</html>')
+		self.assertEqual(results['/gzip'][3], '<html>gzip</html>')
+		self.assertEqual(results['/redirect'][3], '<html>target</html>')
+		self.assertEqual(results['/missing'][0], 404)
+		self.assertIsNone(results['/offsite'])
+
+	def test_reuse_after_server_close(self):
+		# the connection closed by the server is not reused, and the
+		# request on it is sent again on a new connection
+		paths = ['/', '/close', '/', '/gzip']
+		expected = get_results(get_requester(Requester, self.url), paths, sequential=True)
+
+		connections = StandInHandler.connections
+		results = get_results(get_requester(AsyncRequester, self.url), paths, sequential=True)
+
+		self.assertEqual(results, expected)
+		self.assertEqual(results['/gzip'][3], '<html>gzip</html>')
+		self.assertEqual(StandInHandler.connections - connections, 2)
+
+
+@unittest.skipUnless(shutil.which('openssl'), 'openssl is needed to create a certificate')
+class TestAsyncRequesterTunnel(unittest.TestCase):
+
+	@classmethod
+	def setUpClass(cls):
+		cls.directory = tempfile.mkdtemp()
+		cert = os.path.join(cls.directory, 'cert.pem')
+		key = os.path.join(cls.directory, 'key.pem')
+		subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+			'-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1',
+			'-keyout', key, '-out', cert], check=True, capture_output=True)
+
+		server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+		server_context.load_cert_chain(cert, key)
+		cls.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+		cls.server.socket = server_context.wrap_socket(cls.server.socket, server_side=True)
+		start(cls.server)
+
+		cls.proxy = start(TunnelServer(('127.0.0.1', 0), TunnelHandler))
+		cls.client_context = ssl.create_default_context(cafile=cert)
+		cls.url = 'https://127.0.0.1:%s/' % (cls.server.server_address[1], )
+
+	@classmethod
+	def tearDownClass(cls):
+		for server in [cls.server, cls.proxy]:
+			server.shutdown()
+			server.server_close()
+		shutil.rmtree(cls.directory)
+
+	def test_connect_tunnel(self):
+		proxy = '127.0.0.1:%s' % (self.proxy.server_address[1], )
+		paths = ['/', '/chunked', '/redirect', '/missing']
+
+		tunnels = TunnelHandler.tunnels
+		with unittest.mock.patch('ssl._create_default_https_context', lambda: self.client_context):
+			expected = get_results(get_requester(Requester, self.url, proxy), paths)
+		self.assertGreater(TunnelHandler.tunnels, tunnels)
+
+		tunnels = TunnelHandler.tunnels
+		requester = get_requester(AsyncRequester, self.url, proxy)
+		requester.ssl_context = self.client_context
+		results = get_results(requester, paths)
+		self.assertGreater(TunnelHandler.tunnels, tunnels)
+
+		self.assertEqual(results, expected)
+		self.assertEqual(results['/'][3], '<html><title>index</title></html>')
+		self.assertEqual(results['/redirect'][3], '<html>target</html>')
+
+
+if __name__ == '__main__':
+	unittest.main()
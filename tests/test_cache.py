@@ -0,0 +1,45 @@
+"""
+Tests of the cache.
+
+Run from the root of the repository:
+
+	python3 -m unittest discover tests
+"""
+
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from classes.cache import Cache
+
+
+class TestCacheWriter(unittest.TestCase):
+
+	def test_failed_write_does_not_stop_the_writer(self):
+		cache = Cache()
+		written = []
+
+		def fail():
+			raise ValueError('failed write')
+
+		try:
+			cache._write(fail)
+			cache._write(written.append, 'after')
+
+			# save waits for the queued writes
+			saver = threading.Thread(target=cache.save, daemon=True)
+			saver.start()
+			saver.join(5)
+
+			self.assertFalse(saver.is_alive())
+			self.assertEqual(written, ['after'])
+
+		finally:
+			cache.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
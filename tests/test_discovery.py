@@ -0,0 +1,66 @@
+"""
+Tests of the discovery stages that are run for several sites with the
+same fingerprints.
+
+Run from the root of the repository:
+
+	python3 -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from classes.cache import Cache
+from classes.discovery import DiscoverUrlLess
+from classes.fingerprints import Fingerprints
+from classes.matcher import Match
+from classes.printer import Printer
+from classes.request2 import Response
+from classes.results import Results
+
+
+def get_response(url, body):
+	response = Response()
+	response.url = url
+	response.status = {'code': 200, 'text': 'OK'}
+	response.headers = {'content-type': 'text/html'}
+	response.set_body(body)
+	return response
+
+
+class TestDiscoverUrlLess(unittest.TestCase):
+
+	def test_shared_fingerprints_keep_their_url(self):
+		# the url-less fingerprints and their index are kept between
+		# the sites of a scan, so a match must not set the url of the
+		# shared fingerprint
+		fingerprints = Fingerprints(compiled_file=None)
+		fp = fingerprints.get_urlless('cms', 'string')[0]
+		data = {
+			'printer': Printer(0),
+			'fingerprints': fingerprints,
+			'matcher': Match(),
+		}
+
+		page = ('<html>%s</html>' % (fp['match'], )).encode()
+		for url in ['http://h1/x', 'http://h2/y']:
+			data['cache'] = Cache()
+			data['cache'][url] = get_response(url, page)
+			data['results'] = Results({})
+			data['results'].printer = data['printer']
+
+			try:
+				DiscoverUrlLess({}, data).run()
+			finally:
+				data['cache'].close()
+
+			self.assertIn(fp['name'], data['results'].scores['cms'])
+			self.assertEqual(fp['url'], '')
+			self.assertIn(url.split('/', 3)[-1], str(data['results'].sitemap))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,83 @@
+"""
+Tests of the scheduler of the stages of a scan.
+
+Run from the root of the repository:
+
+	python3 -m unittest discover tests
+"""
+
+import contextlib
+import io
+import os
+import re
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from classes.printer import Printer
+from classes.scheduler import StageScheduler
+
+
+class TestStageScheduler(unittest.TestCase):
+
+	def get_stage(self, printer, name, wait=None, done=None, error=None):
+		# a stage that prints two lines, and waits for another stage
+		# in between, so the stages print at the same time
+		def stage():
+			printer.print_debug_line('%s 1' % (name, ), 0)
+			if wait is not None:
+				self.assertTrue(wait.wait(5))
+			printer.print_debug_line('%s 2' % (name, ), 0)
+			if done is not None:
+				done.set()
+			if error is not None:
+				raise error
+
+		return stage
+
+	def run_stages(self, stages):
+		# the lines printed by the stages, without colors, and the error
+		# raised by the run
+		output = io.StringIO()
+		error = None
+		with contextlib.redirect_stdout(output):
+			try:
+				stages.run()
+			except Exception as err:
+				error = err
+
+		return re.sub(r'\x1b\[[0-9;]*m', '', output.getvalue()).splitlines(), error
+
+	def test_output_in_stage_order(self):
+		printer = Printer(0)
+		stages = StageScheduler(printer)
+		b_done = threading.Event()
+
+		# 'a' finishes after 'b', which was added after it
+		stages.add('a', self.get_stage(printer, 'a', wait=b_done))
+		stages.add('b', self.get_stage(printer, 'b', done=b_done))
+		stages.add('c', self.get_stage(printer, 'c'), ['a', 'b'])
+
+		lines, error = self.run_stages(stages)
+		self.assertIsNone(error)
+		self.assertEqual(lines, ['a 1', 'a 2', 'b 1', 'b 2', 'c 1', 'c 2'])
+
+	def test_output_of_a_failed_stage(self):
+		printer = Printer(0)
+		stages = StageScheduler(printer)
+		b_done = threading.Event()
+
+		# 'c' is not run, as 'a' fails
+		stages.add('a', self.get_stage(printer, 'a', wait=b_done, error=ValueError('failed stage')))
+		stages.add('b', self.get_stage(printer, 'b', done=b_done))
+		stages.add('c', self.get_stage(printer, 'c'), ['a'])
+
+		lines, error = self.run_stages(stages)
+		self.assertIsInstance(error, ValueError)
+		self.assertEqual(lines, ['a 1', 'a 2', 'b 1', 'b 2'])
+
+
+if __name__ == '__main__':
+	unittest.main()
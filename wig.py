@@ -37,7 +37,9 @@ from io import open
 
 from classes.cache import Cache
 from classes.results import Results
+from classes.scheduler import StageScheduler
 from classes.fingerprints import Fingerprints
+from classes.fingerprints import FingerprintCompiler
 from classes.headers import ExtractHeaders
 from classes.matcher import Match
 from classes.printer import Printer
@@ -51,6 +53,9 @@ if sys.version_info.major == 3:
     from classes.discovery import *
     from classes.request2 import Requester
     from classes.request2 import UnknownHostName
+    from classes.async_request import AsyncRequester
+
+    requesters = {'threads': Requester, 'asyncio': AsyncRequester}
 
 elif sys.version_info.major == 2:
 
@@ -59,6 +64,8 @@ elif sys.version_info.major == 2:
     from classes2.request2 import Requester
     from classes2.request2 import UnknownHostName
 
+    requesters = {'threads': Requester}
+
 
 
 class Wig(object):
@@ -77,8 +84,6 @@ class Wig(object):
             args.url = 'http://' + args.url
 
         text_printer = Printer(args.verbosity)
-        cache = Cache()
-        cache.printer = text_printer
 
         self.options = {
             'url': args.url.lower(),
@@ -88,11 +93,18 @@ class Wig(object):
             'user_agent': args.user_agent,
             'proxy': args.proxy,
             'verbosity': args.verbosity,
-            'threads': 10,
+            'threads': args.threads,
+            'engine': args.engine,
+            'concurrency': args.concurrency,
+            'max_body_size': args.max_body_size,
+            'max_cache_memory': args.max_cache_memory,
+            'cache_compression': args.cache_compression,
+            'missing_ttl': args.missing_ttl,
             'batch_size': 20,
             'run_all': args.run_all,
             'match_all': args.match_all,
             'stop_after': args.stop_after,
+            'exhaustive_versions': args.exhaustive_versions,
             'no_cache_load': args.no_cache_load,
             'no_cache_save': args.no_cache_save,
             'write_file': args.output_file,
@@ -100,7 +112,7 @@ class Wig(object):
         }
 
         self.data = {
-            'cache': cache,
+            'cache': None,
             'results': Results(self.options),
             'fingerprints': Fingerprints(),
             'matcher': Match(),
@@ -110,6 +122,11 @@ class Wig(object):
             'requested': queue.Queue()
         }
 
+        self.create_cache()
+
+        # compile the regexes of the fingerprints
+        self.data['matcher'].load_regexes(self.data['fingerprints'])
+
         if self.options['write_file'] is not None:
             self.json_outputter = OutputJSON(self.options, self.data)
 
@@ -119,7 +136,7 @@ class Wig(object):
 
     def scan_site(self):
         self.data['results'].printer = self.data['printer']
-        self.data['requester'] = Requester(self.options, self.data)
+        self.data['requester'] = requesters[self.options['engine']](self.options, self.data)
 
         #
         # --- DETECT REDIRECTION ----------------
@@ -171,48 +188,56 @@ class Wig(object):
         if not self.options['no_cache_load']:
             self.data['cache'].load()
 
+        # write the responses to the cache as they arrive
+        if not self.options['no_cache_save']:
+            self.data['cache'].enable_saving()
+
         # timer started after the user interaction
         self.data['timer'] = time.time()
 
 
+        # the stages of the scan. A stage starts as soon as the stages
+        # it depends on have finished, see StageScheduler. Their output
+        # is printed in the order they are added
+        stages = StageScheduler(self.data['printer'])
+
         #
         # --- GET SITE INFO ---------------------
         #
         # get the title
-        title = DiscoverTitle(self.options, self.data).run()
-        self.data['results'].site_info['title'] = title
+        stages.add('title', self.discover_title)
 
         # get the IP of the domain
-        self.data['results'].site_info['ip'] = DiscoverIP(self.options['url']).run()
+        stages.add('ip', self.discover_ip)
 
 
         #
         # --- DETECT ERROR PAGES ----------------
         #
         # find error pages
-        self.data['error_pages'] = DiscoverErrorPage(self.options, self.data).run()
-
-        # set matcher error pages
-        self.data['matcher'].error_pages = self.data['error_pages']
+        stages.add('error_pages', self.discover_error_pages)
 
 
         #
         # --- VERSION DETECTION -----------------
         #
+        # the matcher needs the error pages to tell if a page exists.
         # Search for the first CMS
-        DiscoverCMS(self.options, self.data).run()
+        stages.add('cms', lambda: DiscoverCMS(self.options, self.data).run(), ['error_pages'])
 
         # find Platform
-        DiscoverPlatform(self.options, self.data).run()
+        stages.add('platform', lambda: DiscoverPlatform(self.options, self.data).run(), ['error_pages'])
 
         #
         # --- GET MORE DATA FROM THE SITE -------
         #
         # find interesting files
-        DiscoverInteresting(self.options, self.data).run()
+        stages.add('interesting', lambda: DiscoverInteresting(self.options, self.data).run(), ['error_pages'])
 
-        # find and request links to static files on the pages
-        DiscoverMore(self.options, self.data).run()
+        # find and request links to static files on the pages. This is
+        # done after the other stages have requested their pages
+        stages.add('more', lambda: DiscoverMore(self.options, self.data).run(),
+            ['title', 'cms', 'platform', 'interesting'])
 
 
         #
@@ -220,7 +245,7 @@ class Wig(object):
         #
         # do this after 'DiscoverMore' has been run, to detect JS libs
         # located in places not covered by the fingerprints
-        DiscoverJavaScript(self.options, self.data).run()
+        stages.add('javascript', lambda: DiscoverJavaScript(self.options, self.data).run(), ['more'])
 
 
         #
@@ -228,49 +253,60 @@ class Wig(object):
         #
         # some fingerprints do not have urls - search the cache
         # for matches
-        DiscoverUrlLess(self.options, self.data).run()
+        stages.add('urlless', lambda: DiscoverUrlLess(self.options, self.data).run(), ['more'])
 
         # search for cookies
-        DiscoverCookies(self.data).run()
+        stages.add('cookies', lambda: DiscoverCookies(self.data).run(), ['more'])
 
         # search the cache for headers
-        ExtractHeaders(self.data).run()
+        stages.add('headers', lambda: ExtractHeaders(self.data).run(), ['more'])
 
-        # search for indications of the used operating system
-        DiscoverOS(self.options, self.data).run()
+        # search for indications of the used operating system. This
+        # uses the platforms that have been found
+        stages.add('os', lambda: DiscoverOS(self.options, self.data).run(), ['urlless', 'headers'])
 
         # search for all CMS if specified by the user
+        searched = ['javascript', 'cookies', 'os']
         if self.options['match_all']:
-            DiscoverAllCMS(self.data).run()
+            stages.add('all_cms', lambda: DiscoverAllCMS(self.data).run(), ['os'])
+            searched.append('all_cms')
 
         # mark the end of the run
-        self.data['results'].update()
+        stages.add('update', self.data['results'].update, searched)
 
 
         #
         # --- SEARCH FOR VULNERABILITIES --------
         #
         # search the vulnerability fingerprints for matches
-        DiscoverVulnerabilities(self.data).run()
+        stages.add('vulnerabilities', lambda: DiscoverVulnerabilities(self.data).run(), ['update'])
 
 
         #
         # --- SEARCH FOR TOOLS --------
         #
-        DiscoverTools(self.data).run()
+        stages.add('tools', lambda: DiscoverTools(self.data).run(), ['update'])
 
         #
         # --- SEARCH FOR SUBDOMAINS --------
         #
         if self.options['subdomains']:
-            DiscoverSubdomains(self.options, self.data).run()
+            stages.add('subdomains', lambda: DiscoverSubdomains(self.options, self.data).run())
 
+        # the connections and the cache are closed, also if a stage fails
+        try:
+            stages.run()
 
-        #
-        # --- SAVE THE CACHE --------------------
-        #
-        if not self.options['no_cache_save']:
-            self.data['cache'].save()
+        finally:
+            # close the connections to the host
+            self.data['requester'].close()
+
+            #
+            # --- SAVE THE CACHE --------------------
+            #
+            if not self.options['no_cache_save']:
+                self.data['cache'].save()
+            self.data['cache'].close()
 
         #
         # --- PRINT RESULTS ---------------------
@@ -281,6 +317,19 @@ class Wig(object):
         # update the URL count
         self.data['url_count'] = self.data['cache'].get_num_urls()
 
+        # show how often the cache answered a lookup
+        stats = self.data['cache'].get_stats()
+        self.data['printer'].print_debug_line('Cache lookups: %s hits (%s through canonical urls), %s misses, %s known missing paths' % (
+            stats.get('hits', 0), stats.get('canonical_hits', 0), stats.get('misses', 0), stats.get('missing_hits', 0)), 2)
+
+        # show the time each stage took
+        for name, seconds in stages.get_timings():
+            self.data['printer'].print_debug_line('Stage time: %.4f sec - %s' % (seconds, name), 3)
+
+        # show the regexes that took the most time to match
+        for pattern, seconds in self.data['matcher'].get_slowest_regexes():
+            self.data['printer'].print_debug_line('Regex time: %.4f sec - %s' % (seconds, pattern), 3)
+
         # Create outputter and get results
         if self.options['write_file'] is not None:
             self.json_outputter.add_results()
@@ -289,13 +338,39 @@ class Wig(object):
         outputter.print_results()
 
 
+    def discover_title(self):
+        self.data['results'].site_info['title'] = DiscoverTitle(self.options, self.data).run()
+
+    def discover_ip(self):
+        self.data['results'].site_info['ip'] = DiscoverIP(self.options['url']).run()
+
+    def discover_error_pages(self):
+        self.data['error_pages'] = DiscoverErrorPage(self.options, self.data).run()
+
+        # set matcher error pages
+        self.data['matcher'].error_pages = self.data['error_pages']
+
     def get_results(self):
         return self.data['results'].results
 
 
     def reset(self):
         self.data['results'] = Results(self.options)
-        self.data['cache'] = Cache()
+        self.data['cache'].close()
+        self.create_cache()
+
+    def create_cache(self):
+        cache = Cache()
+        cache.printer = self.data['printer']
+        cache.max_memory = self.options['max_cache_memory']*1024*1024
+        cache.missing_ttl = self.options['missing_ttl']*60*60
+
+        # the caches for the urls in a list share the database
+        if self.data['cache'] is not None:
+            cache.database = self.data['cache'].database
+        cache.database.compression_level = self.options['cache_compression']
+
+        self.data['cache'] = cache
 
     def run(self):
         if self.options['urls'] is not None:
@@ -306,6 +381,8 @@ class Wig(object):
         else:
             self.scan_site()
 
+        self.data['cache'].database.close()
+
         if self.options['write_file'] is not None:
             self.json_outputter.write_file()
 
@@ -331,6 +408,9 @@ def parse_args(url=None):
     parser.add_argument('-m', action='store_true', dest='match_all', default=False,
         help='Try harder to find a match without making more requests')
 
+    parser.add_argument('--exhaustive_versions', action='store_true', default=False,
+        help='Request all the urls of a detected CMS to find its version, instead of only the ones that can narrow it down')
+
     parser.add_argument('-u', action='store_true', dest='user_agent',
         default='Mozilla/5.0 (Windows NT 6.3; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/37.0.2049.0 Safari/537.36',
         help='User-agent to use in the requests')
@@ -341,6 +421,25 @@ def parse_args(url=None):
     parser.add_argument('-t', dest='threads', default=10, type=int,
         help='Number of threads to use')
 
+    parser.add_argument('--engine', dest='engine', default='threads', choices=sorted(requesters),
+        help='Request engine to use. Default: threads')
+
+    parser.add_argument('--concurrency', dest='concurrency', default=10, type=int,
+        help='Number of concurrent requests when using the asyncio engine. More help against slow servers, '
+        'but can overflow the connection backlog of small servers, which then retry the connections after a second. Default: 10')
+
+    parser.add_argument('--max_body_size', dest='max_body_size', default=5*1024*1024, type=int,
+        help='Max number of bytes of a response body to keep. Default: 5 MB')
+
+    parser.add_argument('--max_cache_memory', dest='max_cache_memory', default=256, type=int,
+        help='Max MB of response bodies to keep in memory. Default: 256')
+
+    parser.add_argument('--cache_compression', dest='cache_compression', default=6, type=int, choices=range(10),
+        metavar='LEVEL', help='zlib level (0-9) used to compress the saved responses. Default: 6')
+
+    parser.add_argument('--missing_ttl', dest='missing_ttl', default=24, type=int, metavar='HOURS',
+        help='Hours during which paths found missing are not requested again, 0 to always request them. Default: 24')
+
     parser.add_argument('--no_cache_load', action='store_true', default=False,
         help='Do not load cached responses')
 
@@ -359,11 +458,17 @@ def parse_args(url=None):
     parser.add_argument('-w', dest='output_file', default=None,
         help='File to dump results into (JSON)')
 
+    parser.add_argument('--compile_fingerprints', action='store_true', default=False,
+        help='Compile the fingerprints in data/ for faster loading and exit')
+
     args = parser.parse_args()
 
     if url is not None:
         args.url = url
 
+    if args.compile_fingerprints:
+        return args
+
     if args.input_file is None and args.url is None:
         raise Exception('No target(s) specified')
 
@@ -409,6 +514,10 @@ def wig(**kwargs):
 if __name__ == '__main__':
     args = parse_args()
 
+    if args.compile_fingerprints:
+        print('Compiled fingerprints to: %s' % (FingerprintCompiler().compile(), ))
+        sys.exit(0)
+
     try:
         wig = Wig(args)
         wig.run()